@@ -1,5 +1,6 @@
 import numpy as N
 from scipy import constants as Const
+from scipy.interpolate import RectBivariateSpline
 from crystal_plane import CrystalPlane
 """
 Parallel-band conductivity (Ashcroft & Sturm, 1971) using measured data and
@@ -30,6 +31,40 @@ P111        = N.array([.9887, .9654, .9593, .9166, .865])
 # Plasma frequency:
 #print N.sqrt(mm_sigma_dc / (mm_tau_d * Const.epsilon_0)) * Const.hbar / Const.eV
 
+U200_0 = 0.789 * Const.eV  # mean values from Mathewson & Myers (1972)
+U111_0 = 0.1965 * Const.eV
+
+# Model parameters, in the order they are returned from conductivity()
+parameter_names = ('a', 'k_fermi', 'U111', 'U200', 'm0', 'tau_d', 'tau_pb',
+    'sigma_dc')
+
+# Fits of the model parameters as a function of temperature, done once:
+# (scale factor, polynomial coefficients)
+parameter_fits = {
+    'a': (1.0, N.polyfit(mm_temp, mm_a, 2)),
+    'k_fermi': (1.0, N.polyfit(mm_temp, mm_k_fermi, 2)),
+    'U111': (U111_0, N.polyfit(mm_temp, P111, 2)),
+    'U200': (U200_0, N.polyfit(mm_temp, P200, 2)),
+    'm0': (1.0, N.polyfit(mm_temp, mm_m0, 1)),
+    'tau_d': (1.0, N.polyfit(mm_temp, mm_tau_d, 1)),
+    'tau_pb': (1.0, N.polyfit(mm_temp, mm_tau_pb, 1)),
+    'sigma_dc': (1.0, N.polyfit(mm_temp, mm_sigma_dc, 1))
+}
+
+
+def temperature_parameters(temperature, ndim=0):
+    """
+    Return the model parameters (a, k_fermi, U111, U200, m0, tau_d, tau_pb,
+    sigma_dc) estimated from the fits to Mathewson & Myers' data at
+    @temperature in K, which may be an array. Each parameter gets @ndim extra
+    trailing axes, so that it broadcasts against an @ndim-dimensional array
+    of frequencies.
+    """
+    temperature = N.reshape(temperature, N.shape(temperature) + (1,) * ndim)
+    return tuple(parameter_fits[name][0]
+        * N.polyval(parameter_fits[name][1], temperature)
+        for name in parameter_names)
+
 
 def pb_absorption_energy_range(plane, a, m0, k_fermi, U):
     """
@@ -78,21 +113,66 @@ def imaginary_horrible_function(z, b, t0, rho, phi1, phi2):
     return (J1 + J2 + J3) / (2 * b * N.pi * rho)
 
 
-def parallel_band_conductivity(frequency, plane, a, m0, k_fermi, U, tau):
+def _parallel_band_terms(z, b, t0):
     """
-    Return the contribution to the optical conductivity resulting from
-    parallel-band absorption in a certain plane.
+    Real and imaginary parts of the parallel-band conductivity in units of
+    the prefactor; the same as computing them with horrible_function() and
+    imaginary_horrible_function(), but sharing the intermediate results.
+    Since phi1 = pi / 2 - phi2, only one sine and cosine are needed, and the
+    logarithm and arctangent terms of J(omega) appear in both parts.
+    """
+    z2, b2 = z ** 2, b ** 2
+    rho = ((1 + b2 - z2) ** 2 + (2 * b * z) ** 2) ** 0.25
+    phi2 = 0.5 * (0.5 * N.pi - N.arctan2(1 + b2 - z2, 2 * b * z))
+    sphi, cphi = N.sin(phi2), N.cos(phi2)
+
+    z2b2 = (z2 - b2) / (z2 + b2)
+    zb2 = 2 * z * b / (z2 + b2)
+    log_term = N.log((t0 ** 2 + 2 * t0 * rho * sphi + rho ** 2) /
+                     (t0 ** 2 - 2 * t0 * rho * sphi + rho ** 2))
+    arctan_term = (N.arctan2(t0 + rho * sphi, rho * cphi) +
+                   N.arctan2(t0 - rho * sphi, rho * cphi))
+
+    J = (2 * zb2 * rho * N.arctan(t0)
+         + 0.5 * (cphi * z2b2 + sphi * zb2) * log_term
+         + (sphi * z2b2 - cphi * zb2) * arctan_term) / N.pi
+    realpart = ((z / rho) / (z2 + b2)) * J
+    imagpart = ((0.5 * cphi * log_term + sphi * arctan_term - N.pi * z2b2 * J)
+        / (2 * b * N.pi * rho))
+    return realpart, imagpart
+
+
+def parallel_band_conductivities(frequency, planes, a, m0, k_fermi, U, tau):
+    """
+    Return the contributions to the optical conductivity resulting from
+    parallel-band absorption in several sets of planes, computed in one
+    broadcast over (plane x frequency). The result has the planes along its
+    first axis.
     @frequency: frequency in Hz
-    @plane: a CrystalPlane instance
+    @planes: list of CrystalPlane instances
     @a: lattice constant in m
     @m0: mass ratio
     @k_fermi: fermi wave vector in 1/m
-    @U: crystal plane pseudopotential in J
+    @U: list of the pseudopotentials of @planes in J
     @tau: parallel-band relaxation time in s
     """
-    K = plane.magnitude_factor / a
+    # Put the planes along a new first axis, in front of whatever shape the
+    # frequency and the other parameters broadcast to
+    U = N.array(N.broadcast_arrays(*U))
+    ndim = max([N.ndim(x) for x in (frequency, a, m0, k_fermi, tau)]
+        + [U.ndim - 1])
+    U = U.reshape(U.shape[:1] + (1,) * (ndim - U.ndim + 1) + U.shape[1:])
+    plane_shape = (len(planes),) + (1,) * ndim
+    magnitude_factor = N.reshape([p.magnitude_factor for p in planes],
+        plane_shape)
+    multiplicity = N.reshape([p.multiplicity for p in planes], plane_shape)
+
+    # see pb_absorption_energy_range()
+    K = magnitude_factor / a
+    energy_K = (Const.hbar * K) ** 2 / (2 * m0 * Const.m_e)
+    energy_low = 2 * U
+    energy_high = energy_K * (2 * k_fermi / K - 1)
 
-    energy_low, energy_high = pb_absorption_energy_range(plane, a, m0, k_fermi, U)
     energy = Const.hbar * frequency
     damping_energy = Const.hbar / tau
 
@@ -103,19 +183,34 @@ def parallel_band_conductivity(frequency, plane, a, m0, k_fermi, U, tau):
     # "To obtain the total absorption corresponding to the entire first zone
     # we simply weight these results by the appropriate number of planes
     # bounding the zone."
-    factor = plane.multiplicity * sigma_a * Const.value('Bohr radius') * K
+    factor = multiplicity * sigma_a * Const.value('Bohr radius') * K
 
     b = damping_energy / energy_low
-    rho = ((1 + b ** 2 - z ** 2) ** 2 + (2 * b * z) ** 2) ** 0.25
-    phi1 = 0.5 * (0.5 * N.pi + N.arctan2(1 + b ** 2 - z ** 2, 2 * b * z))
-    phi2 = 0.5 * (0.5 * N.pi - N.arctan2(1 + b ** 2 - z ** 2, 2 * b * z))
-    realpart = (((z / rho) / (z ** 2 + b ** 2))
-        * horrible_function(z, b, t0, rho, phi2))
-    imagpart = imaginary_horrible_function(z, b, t0, rho, phi1, phi2)
+    realpart, imagpart = _parallel_band_terms(z, b, t0)
 
     return factor * (realpart - 1j * imagpart)
 
 
+def parallel_band_conductivity(frequency, plane, a, m0, k_fermi, U, tau):
+    """
+    Return the contribution to the optical conductivity resulting from
+    parallel-band absorption in a certain plane.
+    @frequency: frequency in Hz
+    @plane: a CrystalPlane instance
+    @a: lattice constant in m
+    @m0: mass ratio
+    @k_fermi: fermi wave vector in 1/m
+    @U: crystal plane pseudopotential in J
+    @tau: parallel-band relaxation time in s
+    """
+    return parallel_band_conductivities(frequency, [plane], a, m0, k_fermi,
+        [U], tau)[0]
+
+
+# Planes with parallel-band absorption in aluminum, {200} and {111}
+aluminum_planes = [CrystalPlane(2, 0, 0), CrystalPlane(1, 1, 1)]
+
+
 def drude_conductivity(frequency, sigma_dc, tau_d):
     """
     Return the ideal Drude conductivity as a function of @frequency in Hz,
@@ -142,7 +237,9 @@ def conductivity(frequency, temperature_index=None, temperature=300.0,
 
     If you do not pass @temperature_index, then the function will attempt to
     estimate (by interpolation or extrapolation) parameters for @temperature
-    (in K).
+    (in K). @temperature may be an array, in which case the conductivity is
+    returned for all combinations of temperature and frequency, with shape
+    temperature.shape + frequency.shape.
 
     Passing @include_parallel_band = False will leave out the parallel-band
     resonances, only including the Drude conductivity.
@@ -162,24 +259,8 @@ def conductivity(frequency, temperature_index=None, temperature=300.0,
         tau_pb = mm_tau_pb[index]
         sigma_dc = mm_sigma_dc[index]
     else:
-        a_fit = N.polyfit(mm_temp, mm_a, 2)
-        a = N.polyval(a_fit, temperature)
-        kf_fit = N.polyfit(mm_temp, mm_k_fermi, 2)
-        k_fermi = N.polyval(kf_fit, temperature)
-        U200_0 = 0.789 * Const.eV  # mean values from Mathewson & Myers (1972)
-        U111_0 = 0.1965 * Const.eV
-        P200_fit = N.polyfit(mm_temp, P200, 2)
-        U200 = U200_0 * N.polyval(P200_fit, temperature)
-        P111_fit = N.polyfit(mm_temp, P111, 2)
-        U111 = U111_0 * N.polyval(P111_fit, temperature)
-        m0_fit = N.polyfit(mm_temp, mm_m0, 1)
-        m0 = N.polyval(m0_fit, temperature)
-        tau_d_fit = N.polyfit(mm_temp, mm_tau_d, 1)
-        tau_d = N.polyval(tau_d_fit, temperature)
-        tau_pb_fit = N.polyfit(mm_temp, mm_tau_pb, 1)
-        tau_pb = N.polyval(tau_pb_fit, temperature)
-        sigma_dc_fit = N.polyfit(mm_temp, mm_sigma_dc, 1)
-        sigma_dc = N.polyval(sigma_dc_fit, temperature)
+        a, k_fermi, U111, U200, m0, tau_d, tau_pb, sigma_dc = \
+            temperature_parameters(temperature, N.ndim(frequency))
 
     # Override parameters with keyword arguments if given
     a = kw.get('a', a)  # second argument is default value
@@ -192,11 +273,9 @@ def conductivity(frequency, temperature_index=None, temperature=300.0,
     sigma_dc = kw.get('sigma_dc', sigma_dc)
 
     if include_parallel_band:
-        p200 = CrystalPlane(2, 0, 0)
-        p111 = CrystalPlane(1, 1, 1)
         conductivity = (drude_conductivity(frequency, sigma_dc, tau_d)
-            + parallel_band_conductivity(frequency, p200, a, m0, k_fermi, U200, tau_pb)
-            + parallel_band_conductivity(frequency, p111, a, m0, k_fermi, U111, tau_pb))
+            + parallel_band_conductivities(frequency, aluminum_planes, a, m0,
+                k_fermi, [U200, U111], tau_pb).sum(axis=0))
     else:
         conductivity = drude_conductivity(frequency, sigma_dc, tau_d)
     return conductivity, (a, k_fermi, U111, U200, m0, tau_d, tau_pb, sigma_dc)
@@ -209,3 +288,120 @@ def epsilon_Al_temp(frequency, *args, **kw):
     if full_output:
         return epsilon, parameters
     return epsilon
+
+
+class EpsilonTable:
+    """
+    epsilon_Al_temp() precomputed on a grid of @temperature (in K) and
+    @frequency, and interpolated with bicubic splines of its real and
+    imaginary parts, for evaluating it at many temperatures in a sweep.
+    Keyword arguments are passed on to epsilon_Al_temp().
+    """
+    def __init__(self, temperature, frequency, **kw):
+        self.temperature = N.asarray(temperature)
+        self.frequency = N.asarray(frequency)
+        self.epsilon = epsilon_Al_temp(self.frequency,
+            temperature=self.temperature, **kw)
+        self._real = RectBivariateSpline(self.temperature, self.frequency,
+            self.epsilon.real)
+        self._imag = RectBivariateSpline(self.temperature, self.frequency,
+            self.epsilon.imag)
+
+    def __call__(self, frequency, temperature):
+        """
+        Interpolated epsilon at all combinations of @frequency and
+        @temperature, with shape temperature.shape + frequency.shape like
+        epsilon_Al_temp()
+        """
+        frequency = N.asarray(frequency)
+        temperature = N.asarray(temperature)
+        f, T = frequency.ravel(), temperature.ravel()
+        # The splines are evaluated on a grid of increasing coordinates
+        f_order, T_order = N.argsort(f), N.argsort(T)
+        grid = (self._real(T[T_order], f[f_order])
+            + 1j * self._imag(T[T_order], f[f_order]))
+        retval = N.empty_like(grid)
+        retval[N.ix_(T_order, f_order)] = grid
+        return retval.reshape(temperature.shape + frequency.shape)
+
+
+def fit_temperature_parameters(frequency, temperature, measured,
+    parameters=('U111', 'U200', 'tau_pb'), quantity='epsilon', step=1e-6,
+    tol=1e-10, maxiter=100, **kw):
+    """
+    Fit the model parameters named in @parameters (any of parameter_names) to
+    measurements at several temperatures at once, with a separate value of
+    each parameter for each temperature. The other parameters are taken from
+    temperature_parameters(). All temperatures are fit simultaneously with a
+    Levenberg-Marquardt iteration, in which the model and its Jacobian for
+    all temperatures are computed in one broadcast over (parameter step x
+    temperature x frequency). The Jacobian uses central differences with a
+    relative @step, since the arctangents in the model prevent complex-step
+    derivatives.
+    @frequency: 1-D array of frequencies in Hz
+    @temperature: 1-D array of temperatures in K
+    @measured: array of shape (temperature, frequency) with the measured
+        epsilon, or the reflectance at normal incidence from vacuum if
+        @quantity is 'reflectance'
+    Other keyword arguments are passed on to epsilon_Al_temp().
+    Returns the parameters (a, k_fermi, U111, U200, m0, tau_d, tau_pb,
+    sigma_dc) as arrays over temperature, like conductivity() returns them,
+    and an array of booleans telling whether the fit converged.
+    """
+    frequency = N.asarray(frequency)
+    temperature = N.asarray(temperature)
+    measured = N.asarray(measured)
+    if quantity not in ('epsilon', 'reflectance'):
+        raise ValueError('Unknown quantity {}'.format(quantity))
+    initial = dict(zip(parameter_names, temperature_parameters(temperature)))
+    scale = N.array([initial[name] for name in parameters]).T
+    nparams = len(parameters)
+
+    def model_residuals(x):
+        """Residuals for the relative parameters @x, shape (..., T, P)"""
+        overrides = dict((name, (x[..., ix] * scale[:, ix])[..., N.newaxis])
+            for ix, name in enumerate(parameters))
+        overrides.update(kw)
+        epsilon = epsilon_Al_temp(frequency, temperature=temperature,
+            **overrides)
+        if quantity == 'reflectance':
+            n = N.sqrt(epsilon)
+            return N.abs((n - 1) / (n + 1)) ** 2 - measured
+        r = (epsilon - measured) / N.abs(measured)
+        return N.concatenate((r.real, r.imag), axis=-1)
+
+    # Parameters relative to their initial values, per temperature
+    x = N.ones((temperature.size, nparams))
+    damping = N.ones(temperature.size) * 1e-3
+    converged = N.zeros(temperature.size, dtype=bool)
+    steps = N.vstack((N.zeros(nparams), N.eye(nparams) * step,
+        -N.eye(nparams) * step))[:, N.newaxis, :]
+    for _ in range(maxiter):
+        # Residuals at x and at x +/- step for all parameters at once
+        batch = model_residuals(x + steps)
+        r = batch[0]
+        J = ((batch[1:nparams + 1] - batch[nparams + 1:]) / (2 * step))
+        J = J.transpose(1, 2, 0)  # (T, M, P)
+        cost = (r ** 2).sum(axis=-1)
+
+        JTJ = N.einsum('tmp,tmq->tpq', J, J)
+        JTr = N.einsum('tmp,tm->tp', J, r)
+        diagonal = JTJ[:, N.arange(nparams), N.arange(nparams)]
+        lhs = JTJ.copy()
+        lhs[:, N.arange(nparams), N.arange(nparams)] += (damping[:, N.newaxis]
+            * diagonal)
+        delta = -N.linalg.solve(lhs, JTr[..., N.newaxis])[..., 0]
+        delta[converged] = 0.0
+
+        trial_cost = (model_residuals(x + delta) ** 2).sum(axis=-1)
+        better = trial_cost <= cost
+        x[better] += delta[better]
+        damping = N.where(better, damping * 0.1, damping * 10.0)
+        converged |= (better & (cost - trial_cost <= tol * cost)) | (
+            N.abs(delta).max(axis=-1) <= tol)
+        if N.all(converged):
+            break
+
+    fitted = dict(zip(parameters, (x * scale).T))
+    initial.update(fitted)
+    return tuple(initial[name] for name in parameter_names), converged
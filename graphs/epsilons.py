@@ -1,8 +1,13 @@
 # coding: utf8
 
+import contextlib
+import os.path
 import warnings
 import numpy as N
 from scipy import constants as Const
+from numpy.polynomial.chebyshev import cheb2poly, chebfit
+from scipy.interpolate import InterpolatedUnivariateSpline
+from scipy.optimize import leastsq
 
 ################################################################################
 ## METALS
@@ -84,42 +89,167 @@ def _wavelength_to_frequency(wl):
     return 2 * N.pi * Const.c / wl
 
 
+class LimitsReport:
+    """
+    Fraction of the input of each substance that was outside of its model
+    validity range, recorded by the checks in 'record' mode (see
+    limits_checking) instead of warning on every call.
+    """
+    def __init__(self):
+        self.checked = {}
+        self.outside = {}
+
+    def record(self, substance, inp_array, lower, upper):
+        outside = N.count_nonzero((inp_array < lower) | (inp_array > upper))
+        self.checked[substance] = (self.checked.get(substance, 0)
+            + inp_array.size)
+        self.outside[substance] = self.outside.get(substance, 0) + outside
+
+    def fraction(self, substance):
+        """Fraction of the recorded points of @substance out of range"""
+        return self.outside[substance] / float(self.checked[substance])
+
+    def out_of_range(self):
+        """Names of the substances with any recorded points out of range"""
+        return sorted(s for s in self.outside if self.outside[s])
+
+    def warn(self):
+        """Emit one warning per substance with points out of range"""
+        for substance in self.out_of_range():
+            warnings.warn('{:.1%} of wavelengths are outside of model validity '
+                'range for {}'.format(self.fraction(substance), substance))
+
+    def __str__(self):
+        return '\n'.join('{}: {} of {} points out of range ({:.1%})'.format(
+            s, self.outside[s], self.checked[s], self.fraction(s))
+            for s in sorted(self.checked))
+
+
+# What _check_limits does: 'warn' on every call, 'record' into _limits_report,
+# or 'skip' the check entirely
+_limits_mode = 'warn'
+_limits_report = None
+
+
+@contextlib.contextmanager
+def limits_checking(mode, report=None):
+    """
+    Change what the validity range checks of the epsilon functions do inside a
+    with block: 'warn' on every call (the default), 'record' the out-of-range
+    fraction in the LimitsReport @report, or 'skip' the checks. Use 'skip'
+    inside solver loops after checking the whole wavelength grid once with
+    check_wavelengths():
+        report = check_wavelengths(wl, [epsilon_Au, epsilon_BK7])
+        with limits_checking('skip'):
+            ...
+    """
+    global _limits_mode, _limits_report
+    if mode not in ('warn', 'record', 'skip'):
+        raise ValueError('Unknown limits checking mode {}'.format(mode))
+    if mode == 'record' and report is None:
+        raise ValueError('Please give a LimitsReport to record into')
+    saved = _limits_mode, _limits_report
+    _limits_mode, _limits_report = mode, report
+    try:
+        yield report
+    finally:
+        _limits_mode, _limits_report = saved
+
+
+def check_wavelengths(wavelength, functions, report=None):
+    """
+    Check the wavelength grid @wavelength (in m) against the validity range of
+    each epsilon function in @functions, by evaluating each one once over the
+    whole grid in 'record' mode. Returns @report, or a new LimitsReport.
+    """
+    if report is None:
+        report = LimitsReport()
+    with limits_checking('record', report):
+        for function in functions:
+            function(wavelength)
+    return report
+
+
 def _check_limits(inp, lower, upper, substance):
+    if _limits_mode == 'skip':
+        return
     inp_array = N.asanyarray(inp)
-    if N.any((inp_array < lower) | (inp_array > upper)):
+    if _limits_mode == 'record':
+        _limits_report.record(substance, inp_array, lower, upper)
+    elif N.any((inp_array < lower) | (inp_array > upper)):
         warnings.warn('Wavelength is outside of model validity range for {}'
             .format(substance))
 
 
+class DrudeLorentzMetal:
+    """
+    Drude-Lorentz model of epsilon, with the oscillator parameters converted
+    to angular frequencies once, so that calling the model only evaluates all
+    the oscillators in one broadcast over (wavelength x oscillator).
+
+    Reference: Rakic, Djurisic, Elazar, & Majewski (1998). Optical properties of
+    metallic films for vertical-cavity optoelectronic devices. Applied Optics 37
+    (22), 5271.
+    """
+    def __init__(self, name, plasma_frequency, resonance_strength,
+        damping_frequency, resonance_frequency, limits):
+        """
+        @name: name of the metal, used in warnings
+        @plasma_frequency: plasma frequency in eV
+        @resonance_strength: oscillator strengths
+        @damping_frequency, @resonance_frequency: oscillator parameters in eV
+        @limits: (lower, upper) model validity range in eV
+        """
+        eV = Const.eV / Const.hbar  # eV to rad/s
+        self.name = name
+        self.limits = limits
+        self._strength = (N.array(resonance_strength)
+            * (plasma_frequency * eV) ** 2)
+        self._damping = N.array(damping_frequency) * eV
+        self._resonance2 = (N.array(resonance_frequency) * eV) ** 2
+        self._frequency_limits = (limits[0] * eV, limits[1] * eV)
+
+    @classmethod
+    def from_tables(cls, metal):
+        """Create the model for @metal from the Rakic et al. tables above"""
+        return cls(metal, plasma_frequency[metal], resonance_strength[metal],
+            damping_frequency[metal], resonance_frequency[metal],
+            limits[metal])
+
+    def __call__(self, wavelength):
+        frequency = _wavelength_to_frequency(wavelength)
+        _check_limits(frequency, self._frequency_limits[0],
+            self._frequency_limits[1], self.name)
+
+        w = N.asanyarray(frequency)[..., N.newaxis]
+        oscillators = self._strength / ((self._resonance2 - w ** 2)
+            - 1.0j * self._damping * w)
+        return 1.0 + oscillators.sum(axis=-1)
+
+
 def _drude_lorentz(metal, wavelength):
     """Drude-Lorentz model of epsilon
 
     Reference: Rakic, Djurisic, Elazar, & Majewski (1998). Optical properties of
     metallic films for vertical-cavity optoelectronic devices. Applied Optics 37
     (22), 5271."""
+    return _metal_model(metal)(wavelength)
 
-    frequency = _wavelength_to_frequency(wavelength)
-
-    hf_eV = Const.hbar * frequency / Const.eV
-    _check_limits(hf_eV, limits[metal][0], limits[metal][1], metal)
 
-    # Plasma frequency (rad/s)
-    Omega_p = plasma_frequency[metal] * Const.eV / Const.hbar
+# Precomputed DrudeLorentzMetal models, by name
+metal_models = {}
 
-    retval = N.ones_like(frequency, dtype=complex)
-    parameters = zip(
-        resonance_strength[metal],
-        N.array(damping_frequency[metal]) * Const.eV / Const.hbar,
-        N.array(resonance_frequency[metal]) * Const.eV / Const.hbar)
-    for f, Gamma, omega in parameters:
-        retval += (f * Omega_p ** 2) / ((omega ** 2 - frequency ** 2)
-            - 1.0j * Gamma * frequency)
 
-    return retval
+def _metal_model(metal):
+    if metal not in metal_models:
+        metal_models[metal] = DrudeLorentzMetal.from_tables(metal)
+    return metal_models[metal]
 
 
 def _make_metal_function(metal):
-    retval = lambda x: _drude_lorentz(metal, x)
+    material = _metal_model(metal)
+    retval = lambda x: material(x)
+    retval.material = material
     retval.__doc__ = """
     Dielectric constant of {}, valid from {:.0f} to {:.0f} nm.
     Source: Rakic, Djurisic, Elazar, & Majewski (1998). Optical properties of
@@ -142,10 +272,139 @@ epsilon_Pt = _make_metal_function('Pt')
 epsilon_Ti = _make_metal_function('Ti')
 epsilon_W = _make_metal_function('W')
 
+
+def _drude_lorentz_derivatives(energy, strength, damping, resonance, plasma):
+    """
+    Drude-Lorentz epsilon at the photon energies @energy and its derivatives
+    with respect to the logarithms of the oscillator strengths, damping
+    frequencies and resonance frequencies, in one broadcast over (energy x
+    oscillator). All frequencies in eV. Returns epsilon and the three
+    (energy x oscillator) arrays of derivatives.
+    """
+    E = energy[:, N.newaxis]
+    denominator = resonance ** 2 - E ** 2 - 1.0j * damping * E
+    oscillators = strength * plasma ** 2 / denominator
+    return (1.0 + oscillators.sum(axis=-1), oscillators,
+        1.0j * damping * E * oscillators / denominator,
+        -2.0 * resonance ** 2 * oscillators / denominator)
+
+
+def fit_metal(name, wavelength, epsilon, initial, validity=None,
+    relative=True, maxfev=0):
+    """
+    Fit a Drude-Lorentz model to the dielectric constant @epsilon at the
+    wavelengths @wavelength (in m), for example from a TabulatedMaterial, with
+    leastsq and the analytic Jacobian of the model.
+    @initial: metal in the tables above to start from; this also fixes the
+    plasma frequency and the number of oscillators
+    @validity: (lower, upper) validity range of the model in eV, by default
+    the range of the data
+    @relative: minimize the relative instead of the absolute error
+    The fitted parameters are added to the tables above under @name, so that
+    the model is available like the others, through _make_metal_function.
+    Returns the epsilon function and the RMS (relative) error of the fit.
+    """
+    energy = Const.h * Const.c / (N.asarray(wavelength).ravel() * Const.eV)
+    epsilon = N.asarray(epsilon, dtype=complex).ravel()
+    plasma = plasma_frequency[initial]
+    initial_params = N.array([resonance_strength[initial],
+        damping_frequency[initial], resonance_frequency[initial]])
+    if relative:
+        weight = 1.0 / N.abs(epsilon)
+    else:
+        weight = N.ones_like(energy)
+
+    # The parameters are fit as logarithms to keep them positive; the zero
+    # resonance frequency of the Drude term stays fixed
+    free = initial_params.ravel() > 0
+
+    def params(x):
+        retval = initial_params.ravel().copy()
+        retval[free] = N.exp(x)
+        return retval.reshape(initial_params.shape)
+
+    def residuals(x):
+        strength, damping, resonance = params(x)
+        model = _drude_lorentz_derivatives(energy, strength, damping,
+            resonance, plasma)[0]
+        r = (model - epsilon) * weight
+        return N.concatenate((r.real, r.imag))
+
+    def jacobian(x):
+        strength, damping, resonance = params(x)
+        derivatives = _drude_lorentz_derivatives(energy, strength, damping,
+            resonance, plasma)[1:]
+        J = N.concatenate(derivatives, axis=1)[:, free] * weight[:, N.newaxis]
+        return N.concatenate((J.real, J.imag))
+
+    x, _, _, message, ier = leastsq(residuals,
+        N.log(initial_params.ravel()[free]), Dfun=jacobian, full_output=True,
+        maxfev=maxfev)
+    if ier not in (1, 2, 3, 4):
+        warnings.warn('Drude-Lorentz fit of {} did not converge: {}'
+            .format(name, message))
+
+    strength, damping, resonance = params(x)
+    plasma_frequency[name] = plasma
+    resonance_strength[name] = list(strength)
+    damping_frequency[name] = list(damping)
+    resonance_frequency[name] = list(resonance)
+    if validity is None:
+        validity = (energy.min(), energy.max())
+    limits[name] = validity
+    metal_models.pop(name, None)
+
+    error = N.sqrt(N.mean(residuals(x) ** 2) * 2)
+    return _make_metal_function(name), error
+
 ################################################################################
 ## DIELECTRICS
 
 
+# Sellmeier coefficients A1, B1, A2, B2, ... of the glasses, with B in um
+sellmeier_coefficients = {
+    'BK7': (
+        1.03961212,  N.sqrt(0.00600069867),
+        0.231792344, N.sqrt(0.0200179144),
+        1.01046945,  N.sqrt(103.560653)),
+    'Si3N4': (2.8939, 139.67e-3),
+    'FS': (
+        0.6961663, 0.0684043,
+        0.4079426, 0.1162414,
+        0.8974794, 9.896161),
+    'SF57HHT': (
+        1.81651371,  N.sqrt(0.0143704198),
+        0.428893641, N.sqrt(0.0592801172),
+        1.07186278,  N.sqrt(121.419942)),
+    'MgF2-o': (
+        0.48755108, 0.04338408,
+        0.39875031, 0.09461442,
+        2.3120353,  23.793604),
+    'MgF2-e': (
+        0.41344023, 0.03684262,
+        0.50497499, 0.09076162,
+        2.4904862,  23.771995),
+    'GGG': (
+        1.7727, 0.1567,
+        0.9767, 0.01375,
+        4.9668, 22.715),
+    'F2': (
+        1.34533359, N.sqrt(.00997743871),
+        .209073176, N.sqrt(.0470450767),
+        .937357162, N.sqrt(111.886764)),
+}
+
+# Validity range of the coefficients in meters, where known
+sellmeier_limits = {
+    'BK7': (3e-7, 2.5e-6),
+    'FS': (2.1e-7, 3.71e-6),
+    'MgF2-o': (2e-7, 7e-6),
+    'MgF2-e': (2e-7, 7e-6),
+    'GGG': (3.6e-7, 6e-6),
+    'F2': (3e-7, 2.5e-6),
+}
+
+
 def _sellmeier(wavelength, *args):
     """Sellmeier equation with N terms. constants must be 2*N in length."""
     assert len(args) % 2 == 0
@@ -156,6 +415,62 @@ def _sellmeier(wavelength, *args):
     return epsilon
 
 
+def _check_glass_limits(wavelength, glass):
+    if glass in sellmeier_limits:
+        lower, upper = sellmeier_limits[glass]
+        _check_limits(wavelength, lower, upper, glass)
+
+
+# Zero-padded (term x glass) arrays of A and B**2 for epsilon_glasses, by
+# tuple of glass names
+_sellmeier_tables = {}
+
+
+def _sellmeier_table(glasses):
+    if glasses not in _sellmeier_tables:
+        nterms = max(len(sellmeier_coefficients[g]) // 2 for g in glasses)
+        # Padding terms have A = 0 and contribute nothing
+        A = N.zeros((nterms, len(glasses)))
+        B2 = N.zeros((nterms, len(glasses)))
+        for ix, glass in enumerate(glasses):
+            coefficients = sellmeier_coefficients[glass]
+            nterms = len(coefficients) // 2
+            A[:nterms, ix] = coefficients[0::2]
+            B2[:nterms, ix] = N.array(coefficients[1::2]) ** 2
+        _sellmeier_tables[glasses] = A, B2
+    return _sellmeier_tables[glasses]
+
+
+def epsilon_glasses(wavelength, glasses=None):
+    """
+    Dielectric constants of several glasses in sellmeier_coefficients at
+    once. Each Sellmeier term is evaluated for all glasses in one broadcast
+    over (glass x wavelength), and when warning the limits are only checked
+    against the extremes of the wavelength array.
+    @glasses: sequence of names, default all glasses sorted by name
+    Returns an array of shape (len(glasses),) + wavelength.shape
+    """
+    if glasses is None:
+        glasses = sorted(sellmeier_coefficients)
+    glasses = tuple(glasses)
+    wavelength = N.asanyarray(wavelength)
+    if _limits_mode == 'warn':
+        checked = N.array([wavelength.min(), wavelength.max()])
+    else:
+        # Recording the out-of-range fraction needs all of the points
+        checked = wavelength
+    for glass in glasses:
+        _check_glass_limits(checked, glass)
+
+    A, B2 = _sellmeier_table(glasses)
+    broadcast = (slice(None),) + (N.newaxis,) * wavelength.ndim
+    l2 = (wavelength * 1e6) ** 2
+    epsilon = N.ones((len(glasses),) + wavelength.shape)
+    for A_term, B2_term in zip(A, B2):
+        epsilon += A_term[broadcast] * l2 / (l2 - B2_term[broadcast])
+    return epsilon
+
+
 def epsilon_BK7(wavelength):
     """
     Dielectric constant of BK7 glass, valid from 300 to 2500 nm
@@ -163,11 +478,8 @@ def epsilon_BK7(wavelength):
     2008-02-26 (via www.refractiveindex.info)
     Wavelength in meters
     """
-    _check_limits(wavelength, 3e-7, 2.5e-6, 'BK7')
-    return _sellmeier(wavelength,
-        1.03961212,  N.sqrt(0.00600069867),
-        0.231792344, N.sqrt(0.0200179144),
-        1.01046945,  N.sqrt(103.560653))
+    _check_glass_limits(wavelength, 'BK7')
+    return _sellmeier(wavelength, *sellmeier_coefficients['BK7'])
 
 
 def epsilon_Si3N4(wavelength):
@@ -179,7 +491,7 @@ def epsilon_Si3N4(wavelength):
     nitride." J. Electrochem. Soc. 120 (2), pp. 295-300.
     Wavelength in meters. Unknown validity range.
     """
-    return _sellmeier(wavelength, 2.8939, 139.67e-3)
+    return _sellmeier(wavelength, *sellmeier_coefficients['Si3N4'])
 
 
 def epsilon_Al2O3(wavelength):
@@ -232,11 +544,8 @@ def epsilon_FS(wavelength):
     via refractiveindex.info.
     Wavelength in meters. Valid from 210 to 3710 nm at 20 degrees C.
     """
-    _check_limits(wavelength, 2.1e-7, 3.71e-6, 'FS')
-    return _sellmeier(wavelength,
-        0.6961663, 0.0684043,
-        0.4079426, 0.1162414,
-        0.8974794, 9.896161)
+    _check_glass_limits(wavelength, 'FS')
+    return _sellmeier(wavelength, *sellmeier_coefficients['FS'])
 
 
 def epsilon_SF57HHT(wavelength):
@@ -244,10 +553,7 @@ def epsilon_SF57HHT(wavelength):
     Dielectric function of Schott SF57HHT glass (example high-index glass).
     From refractiveindex.info. Wavelength in meters. Unknown validity range.
     """
-    return _sellmeier(wavelength,
-        1.81651371,  N.sqrt(0.0143704198),
-        0.428893641, N.sqrt(0.0592801172),
-        1.07186278,  N.sqrt(121.419942))
+    return _sellmeier(wavelength, *sellmeier_coefficients['SF57HHT'])
 
 
 def epsilon_MgF2(wavelength, ray='o'):
@@ -257,21 +563,16 @@ def epsilon_MgF2(wavelength, ray='o'):
     pp.1980-1985 via refractiveindex.info.
     Wavelength in meters. Valid from 200 to 7000 nm.
     """
-    _check_limits(wavelength, 2e-7, 7e-6, 'MgF2')
     if ray.startswith('o'):
         # Ordinary ray
-        return _sellmeier(wavelength,
-            0.48755108, 0.04338408,
-            0.39875031, 0.09461442,
-            2.3120353,  23.793604)
+        glass = 'MgF2-o'
     elif ray.startswith('e'):
         # Extraordinary ray
-        return _sellmeier(wavelength,
-            0.41344023, 0.03684262,
-            0.50497499, 0.09076162,
-            2.4904862,  23.771995)
+        glass = 'MgF2-e'
     else:
         raise ValueError('Please specify ordinary or extraordinary ray')
+    _check_glass_limits(wavelength, glass)
+    return _sellmeier(wavelength, *sellmeier_coefficients[glass])
 
 
 def epsilon_GGG(wavelength, T=None):
@@ -284,11 +585,8 @@ def epsilon_GGG(wavelength, T=None):
     other than room temperature are only approximately valid from 360 to
     1800 nm.
     """
-    _check_limits(wavelength, 3.6e-7, 6e-6, 'GGG')
-    epsilon = _sellmeier(wavelength,
-        1.7727, 0.1567,
-        0.9767, 0.01375,
-        4.9668, 22.715)
+    _check_glass_limits(wavelength, 'GGG')
+    epsilon = _sellmeier(wavelength, *sellmeier_coefficients['GGG'])
     if T is None:
         return epsilon
     _check_limits(wavelength, 3.6e-7, 1.8e-6, 'GGG at temperature')
@@ -302,11 +600,331 @@ def epsilon_F2(wavelength):
     Dielectric function of F2 glass, a lead-containing glass type. From
     refractiveindex.info.
     """
-    _check_limits(wavelength, 3e-7, 2.5e-6, 'F2')
-    return _sellmeier(wavelength,
-        1.34533359, N.sqrt(.00997743871),
-        .209073176, N.sqrt(.0470450767),
-        .937357162, N.sqrt(111.886764))
+    _check_glass_limits(wavelength, 'F2')
+    return _sellmeier(wavelength, *sellmeier_coefficients['F2'])
+
+################################################################################
+## TABULATED DATA
+
+
+class TabulatedMaterial:
+    """
+    Dielectric constant interpolated from tabulated n, k data, using cubic
+    splines of the real and imaginary parts of epsilon as a function of
+    photon energy. Call it with a wavelength in meters, like the epsilon_*
+    functions.
+    """
+    def __init__(self, name, energy, wavelength, n, k):
+        """
+        @name: name of the material, used in warnings
+        @energy: photon energies in eV
+        @wavelength: wavelengths in m
+        @n, @k: real and imaginary parts of the index of refraction
+        """
+        order = N.argsort(energy)
+        self.name = name
+        self.energy = N.asarray(energy)[order]
+        self.wavelength = N.asarray(wavelength)[order]
+        self.n = N.asarray(n)[order]
+        self.k = N.asarray(k)[order]
+        self.limits = (self.energy[0], self.energy[-1])
+
+        epsilon = (self.n + 1j * self.k) ** 2
+        self._real = InterpolatedUnivariateSpline(self.energy, epsilon.real)
+        self._imag = InterpolatedUnivariateSpline(self.energy, epsilon.imag)
+
+    @classmethod
+    def from_csv(cls, filename, name=None, skiprows=3):
+        """
+        Load a CSV file with columns energy (eV), wavelength (um), n, k, as
+        exported from the Handbook of Optical Constants. The parsed table is
+        cached next to the CSV file in a binary .cache.npy file, which is used
+        instead of the CSV file as long as it is newer.
+        """
+        if name is None:
+            name = os.path.splitext(os.path.basename(filename))[0]
+        cache_filename = os.path.splitext(filename)[0] + '.cache.npy'
+        try:
+            if os.path.getmtime(cache_filename) < os.path.getmtime(filename):
+                raise IOError('Cache is older than data')
+            table = N.load(cache_filename)
+        except (IOError, OSError):
+            table = N.loadtxt(filename, skiprows=skiprows, delimiter=',',
+                unpack=True)
+            table[1] *= 1e-6  # um to m
+            try:
+                N.save(cache_filename, table)
+            except (IOError, OSError):
+                pass
+        energy, wavelength, n, k = table
+        return cls(name, energy, wavelength, n, k)
+
+    def __call__(self, wavelength):
+        wavelength = N.asanyarray(wavelength)
+        energy = Const.h * Const.c / (wavelength * Const.eV)
+        _check_limits(energy, self.limits[0], self.limits[1], self.name)
+        return (self._real(energy.ravel()) + 1j * self._imag(energy.ravel())
+            ).reshape(energy.shape)
+
+
+# Loaded TabulatedMaterials, by absolute file name
+tabulated_materials = {}
+
+
+def tabulated_material(filename, name=None):
+    """
+    Return a TabulatedMaterial for the n, k data in the CSV file @filename,
+    loading it only once.
+    """
+    key = os.path.abspath(filename)
+    if key not in tabulated_materials:
+        tabulated_materials[key] = TabulatedMaterial.from_csv(filename, name)
+    return tabulated_materials[key]
+
+################################################################################
+## SURROGATES
+
+
+class ChebyshevSurrogate:
+    """
+    Piecewise Chebyshev approximation of an epsilon function over a fixed
+    wavelength interval, for evaluating smooth models many times in inner
+    loops. The interval is split into equal pieces, each with a polynomial of
+    degree @degree, so that evaluating it takes one lookup and @degree
+    multiply-adds. The number of pieces is doubled until the maximum error on
+    a dense check grid is below @tol times the largest |epsilon| in the
+    interval; the achieved error is stored in max_error (absolute) and
+    relative_error. Wavelengths outside the interval are passed to the
+    original function.
+    This pays off for the Drude-Lorentz metals and tabulated materials; the
+    Sellmeier glasses, such as epsilon_BK7, are about twice as fast to
+    evaluate directly as through the lookups of a surrogate.
+    """
+    def __init__(self, function, wl_min, wl_max, tol=1e-8, degree=4,
+        max_pieces=4096):
+        self.function = function
+        self.interval = (wl_min, wl_max)
+        self.tol = tol
+        self.degree = degree
+
+        nodes = N.cos(N.pi * (N.arange(degree + 1) + 0.5) / (degree + 1))
+        pieces = 8
+        while True:
+            width = (wl_max - wl_min) / pieces
+            left = wl_min + width * N.arange(pieces)
+            values = N.asarray(function(
+                left[:, N.newaxis] + 0.5 * width * (nodes + 1)))
+            # Chebyshev interpolation on each piece, converted to powers of
+            # the local coordinate -1 <= x <= 1 for Horner's scheme
+            coefficients = N.array([cheb2poly(chebfit(nodes, v, degree))
+                for v in values.real])
+            if N.iscomplexobj(values):
+                coefficients = coefficients + 1j * N.array(
+                    [cheb2poly(chebfit(nodes, v, degree)) for v in values.imag])
+            self._coefficients = coefficients.T.copy()
+            self._width = width
+            self._pieces = pieces
+
+            check = N.linspace(wl_min, wl_max, 16 * pieces + 1)
+            exact = function(check)
+            error = N.abs(self._evaluate(check) - exact).max()
+            scale = N.abs(exact).max()
+            if error <= tol * scale or pieces >= max_pieces:
+                break
+            pieces *= 2
+
+        self.max_error = error
+        self.relative_error = error / scale
+        if error > tol * scale:
+            warnings.warn('Surrogate only reached a relative error of {:.2g}'
+                .format(self.relative_error))
+
+    def _evaluate(self, wavelength):
+        t = (wavelength - self.interval[0]) / self._width
+        piece = N.clip(t.astype(int), 0, self._pieces - 1)
+        x = 2 * (t - piece) - 1
+        retval = self._coefficients[-1][piece]
+        for c in self._coefficients[-2::-1]:
+            retval = retval * x + c[piece]
+        return retval
+
+    def __call__(self, wavelength):
+        wavelength = N.asanyarray(wavelength)
+        outside = (wavelength < self.interval[0]) | (wavelength > self.interval[1])
+        if N.any(outside):
+            retval = N.asarray(self._evaluate(N.clip(wavelength,
+                *self.interval)))
+            retval[outside] = self.function(wavelength[outside])
+            return retval[()]
+        return self._evaluate(wavelength)
+
+
+# ChebyshevSurrogates, by (function, wl_min, wl_max, tol)
+surrogates = {}
+
+
+def fast_surrogate(function, wl_min, wl_max, tol=1e-8):
+    """
+    Return a ChebyshevSurrogate for the epsilon function @function on the
+    wavelength interval @wl_min to @wl_max (in m), fitting it only once. The
+    surrogate can be used anywhere the function can, e.g.
+    dispersion_relation(wl, [fast_surrogate(epsilon_Au, 5e-7, 1e-6), ...])
+    """
+    key = (function, wl_min, wl_max, tol)
+    if key not in surrogates:
+        surrogates[key] = ChebyshevSurrogate(function, wl_min, wl_max, tol)
+    return surrogates[key]
+
+################################################################################
+## KRAMERS-KRONIG
+
+
+def kramers_kronig_real(eps_imag, padding=2):
+    """
+    Kramers-Kronig transform of the imaginary part of epsilon, @eps_imag,
+    sampled on the uniform frequency grid (k + 1/2) * dw, k = 0, 1, ... along
+    its last axis. Returns the real part minus its high-frequency limit.
+    The principal value integral over the odd extension of @eps_imag is the
+    convolution with 2 / (pi m) for odd offsets m between grid points, which
+    is done with FFTs zero-padded to at least @padding times the length of
+    the odd extension, so that the periodic images do not wrap around. This
+    takes O(N log N) instead of O(N^2). eps_imag must not have a pole at zero
+    frequency; see kramers_kronig_check for removing the Drude term.
+    """
+    eps_imag = N.asarray(eps_imag)
+    npoints = eps_imag.shape[-1]
+    size = 1
+    while size < 2 * npoints * max(padding, 2):
+        size *= 2
+    odd = N.zeros(eps_imag.shape[:-1] + (size,))
+    odd[..., :npoints] = eps_imag
+    odd[..., -npoints:] = -eps_imag[..., ::-1]
+    offset = N.arange(size)
+    offset[size // 2:] -= size
+    kernel = N.zeros(size)
+    kernel[offset % 2 == 1] = 2 / (N.pi * offset[offset % 2 == 1])
+    hilbert = N.fft.irfft(N.fft.rfft(odd) * N.fft.rfft(kernel), size)
+    return -hilbert[..., :npoints]
+
+
+class KramersKronigReport:
+    """
+    Result of kramers_kronig_check() for one epsilon function in a wavelength
+    window: wavelength, epsilon, the real part from the Kramers-Kronig
+    transform kk_real (including eps_inf), and the deviation epsilon.real -
+    kk_real with its maximum and RMS values.
+    """
+    def __init__(self, name, wavelength, epsilon, kk_real, eps_inf):
+        self.name = name
+        self.wavelength = wavelength
+        self.epsilon = epsilon
+        self.eps_inf = eps_inf
+        self.kk_real = kk_real + eps_inf
+        self.deviation = epsilon.real - self.kk_real
+        self.max_deviation = N.abs(self.deviation).max()
+        self.rms_deviation = N.sqrt(N.mean(self.deviation ** 2))
+        self.relative_deviation = self.max_deviation / N.abs(epsilon).max()
+
+    def __str__(self):
+        return ('{}: max deviation {:.3g} ({:.2g} relative), rms {:.3g}, '
+            'eps_inf {:.4g}'.format(self.name, self.max_deviation,
+            self.relative_deviation, self.rms_deviation, self.eps_inf))
+
+
+def kramers_kronig_check(function, wl_min, wl_max, npoints=2 ** 18,
+    extend=20.0, eps_inf=None, support=None):
+    """
+    Check the epsilon function @function for Kramers-Kronig consistency in
+    the wavelength window @wl_min to @wl_max (in m). The imaginary part is
+    sampled on @npoints frequencies from zero up to @extend times the highest
+    frequency in the window, and transformed with kramers_kronig_real(). The
+    discretization error goes as (extend / npoints) ** 2.
+    If the imaginary part rises towards zero frequency, a Drude term matching
+    its lowest frequencies is subtracted and transformed analytically, since
+    its slowly decaying imaginary part would otherwise be cut off at the top
+    of the grid.
+    Functions without absorption on the grid, such as the Sellmeier glasses,
+    have their imaginary part in delta functions at their poles, and are
+    refused with a ValueError.
+    @eps_inf: high-frequency limit of the real part, 1.0 for the Drude-Lorentz
+    models; by default it is fit to the window
+    @support: (shortest, longest) wavelength at which @function is valid, by
+    default the whole grid, or the table for TabulatedMaterials. Above the
+    support frequencies the imaginary part is taken as zero, below it as the
+    Drude term.
+    Returns a KramersKronigReport. The validity range of @function is not
+    checked, since the transform needs it far outside of it.
+    """
+    omega_max = extend * _wavelength_to_frequency(wl_min)
+    omega = (N.arange(npoints) + 0.5) * omega_max / npoints
+    if support is None and isinstance(function, TabulatedMaterial):
+        support = (function.wavelength.min(), function.wavelength.max())
+    if support is None:
+        inside = N.ones(npoints, dtype=bool)
+    else:
+        inside = ((omega >= _wavelength_to_frequency(support[1]))
+            & (omega <= _wavelength_to_frequency(support[0])))
+
+    window = ((omega >= _wavelength_to_frequency(wl_max))
+        & (omega <= _wavelength_to_frequency(wl_min)))
+    with limits_checking('skip'):
+        eps_imag = N.zeros(npoints)
+        eps_imag[inside] = N.imag(function(
+            _wavelength_to_frequency(omega[inside])))
+        epsilon = function(_wavelength_to_frequency(omega[window]))
+
+    material = getattr(function, 'material', function)
+    name = getattr(material, 'name', getattr(function, '__name__', 'epsilon'))
+    if not N.any(eps_imag):
+        raise ValueError('{} has no absorption in the frequency grid, so its '
+            'Kramers-Kronig transform is zero'.format(name))
+
+    # Take out a Drude term -sigma gamma / (omega (omega + i gamma)), for
+    # which omega * eps_imag = sigma gamma^2 / (omega^2 + gamma^2). It is
+    # causal and vanishes at high frequency, so it is subtracted from the
+    # imaginary part and its real part is added to the transform. sigma and
+    # gamma are solved from the complex epsilon at the lowest supported
+    # frequency; both must match the function, or the leftover peak of width
+    # gamma is not resolved by the grid. If that fails, sigma is taken from
+    # omega * eps_imag there and gamma from where it has dropped to half, or
+    # the bottom of the window. Without a Drude term, omega * eps_imag rises
+    # as omega^2 from zero.
+    lowest = N.argmax(inside)
+    drude = N.zeros(npoints, dtype=complex)
+    conductivity = omega * eps_imag
+    if 0 < conductivity[lowest + 1] < 2 * conductivity[lowest]:
+        with limits_checking('skip'):
+            inverse = -1 / function(_wavelength_to_frequency(omega[lowest]))
+        if inverse.real > 0 and inverse.imag > 0:
+            sigma = omega[lowest] / inverse.imag
+            gamma = omega[lowest] * inverse.imag / inverse.real
+        else:
+            warnings.warn('Could not fit the Drude term of {}; taking it '
+                'from the lowest frequency'.format(name))
+            end = lowest + N.argmax(
+                conductivity[lowest:] < conductivity[lowest] / 2)
+            if end == lowest:
+                end = N.argmax(window)
+            sigma, gamma = conductivity[lowest], omega[end]
+        drude = -sigma * gamma / (omega * (omega + 1j * gamma))
+    eps_imag -= drude.imag
+    eps_imag[:lowest] = 0.0
+
+    kk_real = kramers_kronig_real(eps_imag)[window] + drude.real[window]
+
+    # Add the transform of the tail above the grid, where the imaginary part
+    # of each oscillator falls off as omega^-3
+    if inside[-1]:
+        tail = eps_imag[-1] * omega[-1] ** 3
+        top = omega[-1] + 0.5 * omega[0]
+        w = omega[window]
+        kk_real += 2 * tail / (N.pi * w ** 2) * (
+            N.log((top + w) / (top - w)) / (2 * w) - 1 / top)
+    if eps_inf is None:
+        eps_inf = N.mean(N.real(epsilon) - kk_real)
+    return KramersKronigReport(name,
+        _wavelength_to_frequency(omega[window]), epsilon, kk_real, eps_inf)
+
 
 if __name__ == '__main__':
     wl = 800e-9
@@ -4,7 +4,7 @@ import numpy as N
 import plot_config
 from tango import tango
 from matplotlib import pyplot as P
-from epsilons import epsilon_Al
+from epsilons import epsilon_Al, tabulated_material
 
 min_wavelength, max_wavelength = 200e-9, 2000e-9
 percentage_formatter = P.FormatStrFormatter('%i%%')
@@ -15,8 +15,8 @@ n_Al_DL = N.sqrt(epsilon_Al(wl_DL))
 R_DL = N.abs((1 - n_Al_DL) / (1 + n_Al_DL)) ** 2
 
 # Calculate with tabulated data from Palik
-_, wl_P_microns, nr_P, ni_P = N.loadtxt('Aluminum index data.csv',
-    skiprows=3, delimiter=',', unpack=True)
+palik = tabulated_material('Aluminum index data.csv', 'Al (Palik)')
+wl_P_microns, nr_P, ni_P = palik.wavelength * 1e6, palik.n, palik.k
 mask = (wl_P_microns >= min_wavelength * 1e6) & (wl_P_microns <= max_wavelength * 1e6)
 n_Al_P = nr_P[mask] + 1j * ni_P[mask]
 R_P = N.abs((1 - n_Al_P) / (1 + n_Al_P)) ** 2
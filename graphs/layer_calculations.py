@@ -49,6 +49,40 @@ def refl_calc_3layer(kx, k0, eps0, eps1, eps2, eps3, d1, d2):
     return r01, delta1, r0123
 
 
+def refl_calc_multilayer(kx, k0, eps, d):
+    """
+    Reflection and transmission coefficients of a stack of any number of
+    layers, by Airy recursion, with the same conventions as refl_calc.
+    @eps: sequence of the dielectric constants of the layers, including the
+    two semi-infinite outer ones
+    @d: sequence of the thicknesses of the inner layers
+    Every entry of @eps and @d may be an array; they are all broadcast
+    together with @kx and @k0, so maps over angle, wavelength and thickness
+    are calculated in one call.
+    Returns r, t, R, T.
+    """
+    k02 = N.array(k0 ** 2, dtype=complex)
+    kx2 = N.array(kx ** 2)
+    kz = [N.sqrt(e * k02 - kx2) for e in eps]
+    kz[0] = N.where(kz[0].imag > 0, -kz[0], kz[0])
+    kz[1:] = [N.where(k.imag < 0, -k, k) for k in kz[1:]]
+    z = [k / e for k, e in zip(kz, eps)]
+
+    # Start at the last interface and work back towards the first
+    r = (z[-2] - z[-1]) / (z[-2] + z[-1])
+    t = 1 + r
+    for j in range(len(eps) - 3, -1, -1):
+        rj = (z[j] - z[j + 1]) / (z[j] + z[j + 1])
+        phase = N.exp(1j * kz[j + 1] * d[j])
+        delta = phase ** 2
+        denominator = 1 + rj * r * delta
+        r = (rj + r * delta) / denominator
+        t = (1 + rj) * t * phase / denominator
+    R = N.abs(r) ** 2
+    T = (z[-1].real / z[0].real) * N.abs(t) ** 2
+    return r, t, R, T
+
+
 def disp_rel(*args):
     r01, r12, delta, _ = refl_calc(*args)
     return 1.0 + r01 * r12 * delta
@@ -68,6 +102,68 @@ def exact_numerical_nSP(k0, eps0, eps1, eps2, d, guess=None):
     return complex(*kx_solve) / k0
 
 
+def disp_rel_numerator(kx, k0, eps0, eps1, eps2, d):
+    """
+    Return disp_rel multiplied by (z0 + z1) * (z1 + z2), and its analytic
+    derivative with respect to kx. This has the same zeros as disp_rel, but
+    not the pole of r12 at the SP of the 1-2 interface, which lies very
+    close to the zero for thick films.
+    """
+    k02 = N.array(k0 ** 2, dtype=complex)
+    kx2 = N.array(kx ** 2)
+    kz0 = N.sqrt(eps0 * k02 - kx2)
+    kz1 = N.sqrt(eps1 * k02 - kx2)
+    kz2 = N.sqrt(eps2 * k02 - kx2)
+    kz0 = N.where(kz0.imag > 0, -kz0, kz0)
+    kz1 = N.where(kz1.imag < 0, -kz1, kz1)
+    kz2 = N.where(kz2.imag < 0, -kz2, kz2)
+    z0 = kz0 / eps0
+    z1 = kz1 / eps1
+    z2 = kz2 / eps2
+    delta = N.exp(2j * kz1 * d)
+    # dkz/dkx = -kx / kz, whichever sign of kz was chosen
+    dz0 = -kx / (kz0 * eps0)
+    dz1 = -kx / (kz1 * eps1)
+    dz2 = -kx / (kz2 * eps2)
+    ddelta = -2j * d * kx / kz1 * delta
+
+    g = (z0 + z1) * (z1 + z2) + (z0 - z1) * (z1 - z2) * delta
+    dg = ((dz0 + dz1) * (z1 + z2) + (z0 + z1) * (dz1 + dz2)
+        + ((dz0 - dz1) * (z1 - z2) + (z0 - z1) * (dz1 - dz2)) * delta
+        + (z0 - z1) * (z1 - z2) * ddelta)
+    return g, dg
+
+
+def exact_numerical_nSP_array(k0, eps0, eps1, eps2, d, guess=None, tol=1e-12,
+    maxiter=50):
+    """
+    Vectorized version of exact_numerical_nSP. Solves for the SP index at
+    every combination of @k0, @eps0, @eps1, @eps2, and @d (which are
+    broadcast together) at once, with Newton's method on
+    disp_rel_numerator.
+    @guess: initial kx, default is the SP on an infinitely thick film
+    Returns the SP index, and a boolean array that is True where the
+    iteration converged.
+    """
+    k0, eps0, eps1, eps2, d = N.broadcast_arrays(k0, eps0, eps1, eps2, d)
+    if guess is None:
+        guess = k0 * infinite_nSP(eps1, eps2)
+    kx = N.array(guess * N.ones(k0.shape), dtype=complex)
+    converged = N.zeros(kx.shape, dtype=bool)
+
+    with N.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(maxiter):
+            f, df = disp_rel_numerator(kx, k0, eps0, eps1, eps2, d)
+            step = N.where(converged, 0, f / df)
+            kx = kx - step
+            converged |= abs(step) <= tol * abs(kx)
+            if N.all(converged | ~N.isfinite(kx)):
+                break
+
+    converged &= N.isfinite(kx)
+    return kx / k0, converged
+
+
 def infinite_nSP(eps1, eps2):
     return N.sqrt(eps1 * eps2 / (eps1 + eps2))
 
@@ -91,3 +187,119 @@ def find_optimum_thickness(k0, eps0, eps1, eps2):
     else:
         thickness = dip_minimum(kx, k0, eps0, eps1, eps2).real
     return thickness
+
+
+def dip_minimum_derivative(kx, k0, eps0, eps1, eps2):
+    """Return dip_minimum and its analytic derivative with respect to kx"""
+    r01, r12, _, _ = refl_calc(kx, k0, eps0, eps1, eps2, 0.0)
+    k02 = N.array(k0 ** 2, dtype=complex)
+    kx2 = N.array(kx ** 2)
+    kz0 = N.sqrt(eps0 * k02 - kx2)
+    kz1 = N.sqrt(eps1 * k02 - kx2)
+    kz2 = N.sqrt(eps2 * k02 - kx2)
+    kz0 = N.where(kz0.imag > 0, -kz0, kz0)
+    # dip_minimum uses the principal root for kz1, refl_calc does not
+    kz1_refl = N.where(kz1.imag < 0, -kz1, kz1)
+    kz2 = N.where(kz2.imag < 0, -kz2, kz2)
+    z0 = kz0 / eps0
+    z1 = kz1_refl / eps1
+    z2 = kz2 / eps2
+    # dkz/dkx = -kx / kz, whichever sign of kz was chosen
+    dz0 = -kx / (kz0 * eps0)
+    dz1 = -kx / (kz1_refl * eps1)
+    dz2 = -kx / (kz2 * eps2)
+    dr01 = 2 * (z1 * dz0 - z0 * dz1) / (z0 + z1) ** 2
+    dr12 = 2 * (z2 * dz1 - z1 * dz2) / (z1 + z2) ** 2
+
+    log_ratio = N.log(-r01 / r12)
+    thickness = -1j * log_ratio / (2 * kz1)
+    dthickness = (-1j * (dr01 / r01 - dr12 / r12) / (2 * kz1)
+        - 1j * log_ratio * kx / (2 * kz1 ** 3))
+    return thickness, dthickness
+
+
+def _optimum_kx(kx, k0, eps0, eps1, eps2, tol, maxiter):
+    """
+    Find the real kx near @kx at which dip_minimum is real. The imaginary part
+    of dip_minimum is far from linear near the SP, so first search outward
+    from @kx for an interval in which it changes sign, staying between the
+    light lines of eps2 and eps0 where the SP can be excited; then converge
+    with Newton's method, falling back to bisection whenever a Newton step
+    leaves the interval.
+    """
+    f = lambda x: dip_minimum(x, k0, eps0, eps1, eps2).imag
+    lower = k0 * N.sqrt(N.real(eps2)) * (1 + 1e-9)
+    upper = k0 * N.sqrt(N.real(eps0)) * (1 - 1e-9)
+    kx = N.clip(kx, lower, upper)
+
+    with N.errstate(divide='ignore', invalid='ignore'):
+        lo, hi = kx.copy(), kx.copy()
+        f_lo = f_hi = f(kx)
+        width = 1e-3 * kx
+        for _ in range(maxiter):
+            bracketed = N.sign(f_lo) != N.sign(f_hi)
+            if N.all(bracketed):
+                break
+            lo = N.where(bracketed, lo, N.maximum(kx - width, lower))
+            hi = N.where(bracketed, hi, N.minimum(kx + width, upper))
+            f_lo, f_hi = f(lo), f(hi)
+            width *= 2
+        bracketed = N.sign(f_lo) != N.sign(f_hi)
+
+        # Keep f(neg) < 0 < f(pos)
+        neg = N.where(f_lo < 0, lo, hi)
+        pos = N.where(f_lo < 0, hi, lo)
+        kx = 0.5 * (lo + hi)
+        converged = ~bracketed
+        for _ in range(maxiter):
+            thickness, dthickness = dip_minimum_derivative(kx, k0, eps0, eps1,
+                eps2)
+            neg = N.where(thickness.imag < 0, kx, neg)
+            pos = N.where(thickness.imag < 0, pos, kx)
+            new_kx = kx - thickness.imag / dthickness.imag
+            outside = ~((new_kx - neg) * (new_kx - pos) < 0)
+            new_kx = N.where(outside, 0.5 * (neg + pos), new_kx)
+            new_kx = N.where(converged, kx, new_kx)
+            converged |= abs(new_kx - kx) <= tol * abs(kx)
+            kx = new_kx
+            if N.all(converged):
+                break
+
+    return kx, converged & bracketed
+
+
+def find_optimum_thickness_array(k0, eps0, eps1, eps2, tol=1e-12, maxiter=50):
+    """
+    Vectorized version of find_optimum_thickness, for every combination of
+    @k0, @eps0, @eps1 and @eps2 (which are broadcast together). Points that
+    do not converge from the default guess are retried, starting from the
+    effective index of their nearest converged neighbour in the flattened
+    array (e.g. the adjacent wavelength of a sweep).
+    Returns the thickness, and a boolean array that is True where the
+    iteration converged.
+    """
+    k0, eps0, eps1, eps2 = N.broadcast_arrays(k0, eps0, eps1, eps2)
+    shape = k0.shape
+    k0, eps0, eps1, eps2 = [N.ravel(x) for x in (k0, eps0, eps1, eps2)]
+
+    kx_guess = k0 * infinite_nSP(eps1, eps2).real * 0.98
+    kx, converged = _optimum_kx(kx_guess, k0, eps0, eps1, eps2, tol, maxiter)
+
+    while 0 < N.count_nonzero(converged) < converged.size:
+        good = N.flatnonzero(converged)
+        bad = N.flatnonzero(~converged)
+        pos = N.searchsorted(good, bad)
+        left = good[N.maximum(pos - 1, 0)]
+        right = good[N.minimum(pos, good.size - 1)]
+        neighbour = N.where(abs(left - bad) <= abs(right - bad), left, right)
+
+        kx_retry, converged_retry = _optimum_kx(
+            k0[bad] * kx[neighbour] / k0[neighbour],
+            k0[bad], eps0[bad], eps1[bad], eps2[bad], tol, maxiter)
+        if not N.any(converged_retry):
+            break
+        kx[bad] = kx_retry
+        converged[bad] = converged_retry
+
+    thickness = dip_minimum(kx, k0, eps0, eps1, eps2).real
+    return thickness.reshape(shape), converged.reshape(shape)
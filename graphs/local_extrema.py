@@ -3,16 +3,22 @@ import scipy.ndimage.filters as filters
 import scipy.ndimage.morphology as morphology
 
 
-def detect_local_minima(arr):
+def detect_local_minima(arr, ndim=None):
     # http://stackoverflow.com/questions/3684484/peak-detection-in-a-2d-array/3689710#3689710
     """
     Takes an array and detects the troughs using the local maximum filter.
     Returns a boolean mask of the troughs (i.e. 1 when
     the pixel's value is the neighborhood maximum, 0 otherwise)
+    @ndim: number of trailing axes that make up the neighborhood; any leading
+    axes are treated as a stack of independent arrays. Default is all axes.
     """
+    if ndim is None:
+        ndim = arr.ndim
     # define a connected neighborhood
     # http://www.scipy.org/doc/api_docs/SciPy.ndimage.morphology.html#generate_binary_structure
-    neighborhood = morphology.generate_binary_structure(len(arr.shape), 2)
+    neighborhood = morphology.generate_binary_structure(ndim, 2)
+    neighborhood = neighborhood.reshape(
+        (1,) * (arr.ndim - ndim) + neighborhood.shape)
     # apply the local minimum filter; all locations of minimum value
     # in their neighborhood are set to 1
     # http://www.scipy.org/doc/api_docs/SciPy.ndimage.filters.html#minimum_filter
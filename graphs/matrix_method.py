@@ -1,36 +1,123 @@
+import warnings
 import numpy as N
 from local_extrema import detect_local_minima
 
+# Default limit for the temporary arrays of calc_eigenvalue_element, in bytes
+default_memory = 512 * 2 ** 20
+
 
 def create_eigenvalue_grid(rmin, rmax, imin, imax, k0, npoints=200):
     """
     Use broadcasting to create a matrix of possible kSP values.
     @rmin, @rmax: real part of effective SP index
     @imin, @imax: imaginary part of effective SP index
+    Any of the bounds and @k0 may also be arrays of the same shape (for
+    example, one entry per wavelength); in that case their shape becomes the
+    leading dimension of the returned kr, ki, and kSP arrays.
     """
-    kr = N.linspace(rmin * k0, rmax * k0, npoints)
-    ki = N.linspace(imin * k0, imax * k0, npoints - 1)
+    rmin, rmax, imin, imax, k0 = [N.asarray(x)[..., N.newaxis]
+        for x in (rmin, rmax, imin, imax, k0)]
+    tr = N.linspace(0.0, 1.0, npoints)
+    ti = N.linspace(0.0, 1.0, npoints - 1)
+    kr = (rmin + (rmax - rmin) * tr) * k0
+    ki = (imin + (imax - imin) * ti) * k0
     # take -1 so that the dimensions are not equal - this will raise a
     # broadcasting error if we get the dimensions mixed up, hopefully
-    kSP = (kr[:, N.newaxis] + 1j * ki[N.newaxis, :])
+    kSP = (kr[..., :, N.newaxis] + 1j * ki[..., N.newaxis, :])
     return kr, ki, kSP
 
 
-def calc_eigenvalue_matrix(k0, eps, d, kSP):
+def _layer_wave_vectors(k0, eps, kSP):
     """
-    Calculate the matrix element M22 which must be 0.
+    Calculate kz and zeta = kz / eps in each layer. The layer axis comes
+    first in the returned arrays, so that each layer is a contiguous array.
     """
+    eps = N.asarray(eps)[..., N.newaxis, N.newaxis, :]
+    k0 = N.asarray(k0)[..., N.newaxis, N.newaxis]
+    # Line up the layer axis of eps with the broadcast dimensions of all the
+    # inputs, which may have more leading dimensions than eps
+    ndim = max(k0.ndim, eps.ndim - 1, N.ndim(kSP))
+    eps = N.rollaxis(eps.reshape((1,) * (ndim + 1 - eps.ndim) + eps.shape), -1)
+
     # Calculate kz in each layer
-    kz = N.sqrt(eps * k0 ** 2 - kSP[..., N.newaxis] ** 2)
+    kz = N.sqrt(eps * k0 ** 2 - kSP ** 2)
     # Choose the sign of kz so that the imaginary part is positive
     kz = N.where(kz.imag < 0, -kz, kz)
-    kz[..., 0] *= -1
+    kz[0] *= -1
+    return kz, kz / eps
+
+
+def _transfer_elements(kz, zeta, d):
+    """
+    Multiply the transfer matrices of all the interfaces and layers, keeping
+    the four matrix elements in separate arrays (m00, m01, m10, m11). Each
+    layer is applied in closed form, element by element, writing into two
+    sets of buffers that are swapped after every layer; apart from those and
+    a few scratch arrays nothing is allocated inside the loop.
+    """
+    shape = kz.shape[1:]
+    m00, m01, m10, m11 = [N.empty(shape, dtype=complex) for _ in range(4)]
+    n00, n01, n10, n11 = [N.empty(shape, dtype=complex) for _ in range(4)]
+    r, p, q, rp, rq, tmp = [N.empty(shape, dtype=complex) for _ in range(6)]
+
+    # First interface: [[1, r10], [r10, 1]] / t10
+    z0 = zeta[0]
+    z1 = zeta[1]
+    N.subtract(z1, z0, out=r)
+    N.add(z1, z0, out=tmp)
+    N.divide(r, tmp, out=r)
+    N.add(r, 1, out=tmp)
+    N.divide(1, tmp, out=m00)
+    N.divide(r, tmp, out=m01)
+    m10[...] = m01
+    m11[...] = m00
+
+    # Following layers: [[dplus, rn1n * dminus], [rn1n * dplus, dminus]] / tn1n
+    for ix, dn in enumerate(d, 1):
+        zn = zeta[ix]
+        zn1 = zeta[ix + 1]
+        N.subtract(zn1, zn, out=r)
+        N.add(zn1, zn, out=tmp)
+        N.divide(r, tmp, out=r)
+        N.add(r, 1, out=tmp)
+        N.multiply(kz[ix], 1j * dn, out=p)
+        N.exp(p, out=p)
+        N.multiply(kz[ix], -1j * dn, out=q)
+        N.exp(q, out=q)
+        N.divide(p, tmp, out=p)
+        N.divide(q, tmp, out=q)
+        N.multiply(r, p, out=rp)
+        N.multiply(r, q, out=rq)
+
+        N.multiply(p, m00, out=n00)
+        N.multiply(rq, m10, out=tmp)
+        N.add(n00, tmp, out=n00)
+        N.multiply(p, m01, out=n01)
+        N.multiply(rq, m11, out=tmp)
+        N.add(n01, tmp, out=n01)
+        N.multiply(rp, m00, out=n10)
+        N.multiply(q, m10, out=tmp)
+        N.add(n10, tmp, out=n10)
+        N.multiply(rp, m01, out=n11)
+        N.multiply(q, m11, out=tmp)
+        N.add(n11, tmp, out=n11)
+
+        m00, m01, m10, m11, n00, n01, n10, n11 = \
+            n00, n01, n10, n11, m00, m01, m10, m11
+
+    return m00, m01, m10, m11
+
 
+def _transfer_matrix_einsum(kz, zeta, d):
+    """
+    Reference implementation of _transfer_elements, building a stack of 2x2
+    matrices for each layer and multiplying them with einsum.
+    """
     # Pre-calculate the first matrix multiplication for the first interface
-    matrix_shape = (kSP.shape[0], kSP.shape[1], 2, 2)
+    matrix_shape = kz.shape[1:] + (2, 2)
     M0 = N.ones(matrix_shape, dtype=complex)
-    z0 = kz[..., 0] / eps[0]
-    z1 = kz[..., 1] / eps[1]
+    z0 = zeta[0]
+    z1 = zeta[1]
     r10 = (z1 - z0) / (z1 + z0)
     t10 = 1 + r10
     M0[..., 1, 0] = r10
@@ -39,11 +126,11 @@ def calc_eigenvalue_matrix(k0, eps, d, kSP):
     del z0, z1, r10, t10
 
     # Iterate over the following layers
-    for dn, en, kzn, zn1 in zip(d, eps[1:-1],
-                                  N.rollaxis(kz[..., 1:-1], 2),
-                                  N.rollaxis(kz[..., 2:] / eps[2:], 2)):
+    for ix, dn in enumerate(d, 1):
+        kzn = kz[ix]
+        zn = zeta[ix]
+        zn1 = zeta[ix + 1]
         M1 = N.empty_like(M0)
-        zn = kzn / en
         rn1n = (zn1 - zn) / (zn1 + zn)
         tn1n = 1 + rn1n
         kd = 1j * kzn * dn
@@ -62,86 +149,529 @@ def calc_eigenvalue_matrix(k0, eps, d, kSP):
     return M0
 
 
+def calc_eigenvalue_matrix(k0, eps, d, kSP, fused=True):
+    """
+    Calculate the transfer matrix of the layer stack, whose element M22 must
+    be 0.
+    @k0: free-space wave vector, scalar or array of shape (...)
+    @eps: dielectric constants of the layers, shape (nlayers,) or
+    (..., nlayers)
+    @d: thicknesses of the inner layers, shape (nlayers - 2,)
+    @kSP: grid of trial wave vectors, shape (..., nr, ni)
+    @fused: multiply the layer matrices element by element in closed form
+    (False: use the slower einsum implementation)
+    Any leading dimensions (...) of @k0, @eps, and @kSP are broadcast
+    together, so a whole spectrum can be calculated in one pass.
+    """
+    kz, zeta = _layer_wave_vectors(k0, eps, kSP)
+    if not fused:
+        return _transfer_matrix_einsum(kz, zeta, d)
+
+    elements = _transfer_elements(kz, zeta, d)
+    del kz, zeta
+    M = N.empty(elements[0].shape + (2, 2), dtype=complex)
+    M[..., 0, 0], M[..., 0, 1], M[..., 1, 0], M[..., 1, 1] = elements
+    return M
+
+
+def calc_eigenvalue_element(k0, eps, d, kSP, element=(1, 1),
+    memory=default_memory, out=None):
+    """
+    Calculate only the requested element(s) of the transfer matrix, like
+    calc_eigenvalue_matrix(k0, eps, d, kSP)[..., i, j], but in row-wise tiles
+    of the kSP grid so that the temporary arrays stay within @memory bytes.
+    @element: an (i, j) pair, or a list of pairs; in the latter case the
+    output has an extra trailing axis with one entry per pair
+    @out: preallocated C-contiguous complex output array to write into
+    """
+    eps = N.asarray(eps)
+    elements = N.atleast_2d(element)
+    shape = N.broadcast(N.empty(N.shape(k0) + (1, 1)),
+        N.empty(eps.shape[:-1] + (1, 1)), kSP).shape
+    out_shape = shape if N.ndim(element) == 1 else shape + (len(elements),)
+    if out is None:
+        out = N.empty(out_shape, dtype=complex)
+    elif (out.shape != out_shape or out.dtype != complex
+        or not out.flags.c_contiguous):
+        # Otherwise the reshape below would silently write into a copy
+        raise ValueError('out must be a C-contiguous complex array of shape '
+            '{}'.format(out_shape))
+    out_view = out.reshape(shape + (len(elements),))
+
+    # Rough count of the bytes of temporaries per grid point: kz and zeta for
+    # every layer and their intermediates, and the buffers of
+    # _transfer_elements
+    bytes_per_point = 16 * (4 * eps.shape[-1] + 14)
+    points_per_row = N.prod(shape[:-2] + shape[-1:], dtype=int)
+    rows = max(1, int(memory // (bytes_per_point * points_per_row)))
+
+    for start in range(0, shape[-2], rows):
+        kz, zeta = _layer_wave_vectors(k0, eps, kSP[..., start:start + rows, :])
+        M = _transfer_elements(kz, zeta, d)
+        del kz, zeta
+        for ix, (i, j) in enumerate(elements):
+            out_view[..., start:start + rows, :, ix] = M[2 * i + j]
+        del M
+    return out
+
+
+def eigenvalue_condition(k0, eps, d, mode):
+    """
+    Evaluate M22 at the effective indices @mode, which may have any shape
+    (...) that broadcasts with the leading dimensions of @k0 and @eps.
+    """
+    kSP = (N.asarray(mode) * N.asarray(k0))[..., N.newaxis, N.newaxis]
+    return calc_eigenvalue_matrix(k0, eps, d, kSP)[..., 0, 0, 1, 1]
+
+
+def polish_mode(k0, eps, d, mode, tol=1e-13, maxiter=50, step=1e-3):
+    """
+    Converge on a zero of M22 near the approximate effective index @mode,
+    using Muller's method. @k0, @eps and @mode may have a leading batch
+    dimension as in calc_eigenvalue_matrix; all modes are iterated together.
+    @tol: relative change in the effective index at which to stop
+    @step: offset of the two extra starting points from @mode
+    Returns the polished effective indices and a boolean array which is True
+    where the iteration converged.
+    """
+    f = lambda x: eigenvalue_condition(k0, eps, d, x)
+    x2 = N.array(mode, dtype=complex)
+    x0 = x2 - step
+    x1 = x2 + 1j * step
+    f0, f1, f2 = f(x0), f(x1), f(x2)
+    converged = N.zeros(x2.shape, dtype=bool)
+
+    with N.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(maxiter):
+            # Fit a parabola through the last three points and step to its
+            # root closest to x2
+            h1, h2 = x1 - x0, x2 - x1
+            d1, d2 = (f1 - f0) / h1, (f2 - f1) / h2
+            a = (d2 - d1) / (h2 + h1)
+            b = a * h2 + d2
+            disc = N.sqrt(b ** 2 - 4 * a * f2)
+            den = N.where(abs(b + disc) > abs(b - disc), b + disc, b - disc)
+            dx = -2 * f2 / den
+            # Already converged modes (or exact zeros) stay put
+            dx = N.where(converged | (f2 == 0), 0, dx)
+
+            x0, x1, x2 = x1, x2, x2 + dx
+            f0, f1, f2 = f1, f2, f(x2)
+            converged |= abs(dx) <= tol * abs(x2)
+            if N.all(converged | ~N.isfinite(x2)):
+                break
+
+    converged &= N.isfinite(x2)
+    return x2, converged
+
+
+def _winding_number(f, corners, npoints=16, max_refine=12):
+    """
+    Count the zeros minus the poles of @f inside the polygon @corners (given
+    counter-clockwise), by following the argument of @f around its edges.
+    Edge segments where the argument changes by more than 60 degrees are
+    bisected until it is resolved.
+    """
+    t = N.linspace(0.0, 1.0, npoints, endpoint=False)
+    ends = N.roll(corners, -1)
+    z = (corners[:, N.newaxis] + (ends - corners)[:, N.newaxis] * t).ravel()
+    z = N.append(z, corners[0])
+    fz = f(z)
+
+    for _ in range(max_refine):
+        dphase = N.angle(fz[1:] / fz[:-1])
+        unresolved = N.flatnonzero(abs(dphase) > N.pi / 3)
+        if unresolved.size == 0:
+            break
+        mid = 0.5 * (z[unresolved] + z[unresolved + 1])
+        z = N.insert(z, unresolved + 1, mid)
+        fz = N.insert(fz, unresolved + 1, f(mid))
+    else:
+        warnings.warn('Argument of M22 not resolved along contour; '
+            'is there a mode or branch cut on the edge?')
+        dphase = N.angle(fz[1:] / fz[:-1])
+
+    return int(round(dphase.sum() / (2 * N.pi)))
+
+
+def find_modes(k0, eps, d, bounds=(1.0, 1.1, 0.0001, 0.1), npoints=16,
+    max_depth=12):
+    """
+    Find all the zeros of M22 inside the rectangle @bounds = (min real, max
+    real, min imag, max imag) of the complex effective index plane, using the
+    argument principle. Rectangles are subdivided only if they contain more
+    than one zero; a single zero is then converged on with polish_mode(). This
+    does not miss modes close to the edges of @bounds, as the grid search
+    does. M22 has poles only at the branch points n^2 = eps of the layers, so
+    keep those out of @bounds.
+    @k0, @eps: as for calc_eigenvalue_matrix, for a single wavelength
+    @npoints: initial number of points per edge of each rectangle
+    @max_depth: maximum number of subdivisions
+    Returns an array of effective indices, sorted by real part.
+    """
+    f = lambda x: eigenvalue_condition(k0, eps, d, x)
+    modes = []
+    rectangles = [(tuple(bounds), 0)]
+    while rectangles:
+        (xmin, xmax, ymin, ymax), depth = rectangles.pop()
+        corners = N.array([xmin + 1j * ymin, xmax + 1j * ymin,
+            xmax + 1j * ymax, xmin + 1j * ymax])
+        count = _winding_number(f, corners, npoints)
+        if count <= 0:
+            continue
+
+        if count == 1:
+            mode, converged = polish_mode(k0, eps, d,
+                0.5 * (xmin + xmax) + 0.5j * (ymin + ymax))
+            if (converged and xmin <= mode.real <= xmax
+                and ymin <= mode.imag <= ymax):
+                modes.append(complex(mode))
+                continue
+
+        if depth >= max_depth:
+            warnings.warn('Could not separate {} modes near {}'.format(
+                count, corners.mean()))
+            continue
+
+        # Split the longer side slightly off-center, so that symmetrically
+        # placed zeros do not end up on the new edge
+        if xmax - xmin >= ymax - ymin:
+            xsplit = xmin + 0.4913 * (xmax - xmin)
+            rectangles.append(((xmin, xsplit, ymin, ymax), depth + 1))
+            rectangles.append(((xsplit, xmax, ymin, ymax), depth + 1))
+        else:
+            ysplit = ymin + 0.4913 * (ymax - ymin)
+            rectangles.append(((xmin, xmax, ymin, ysplit), depth + 1))
+            rectangles.append(((xmin, xmax, ysplit, ymax), depth + 1))
+
+    return N.array(sorted(modes, key=lambda m: (m.real, m.imag)))
+
+
+def layer_epsilons(wavelengths, epsilon_functions):
+    """
+    Evaluate the dielectric constant of every layer at every wavelength.
+    Returns an array of shape (wavelengths.shape + (nlayers,)). The epsilon
+    functions must accept an array of wavelengths; functions returning a
+    constant are broadcast.
+    """
+    wavelengths = N.asarray(wavelengths)
+    eps = N.empty(wavelengths.shape + (len(epsilon_functions),), dtype=complex)
+    for ix, e in enumerate(epsilon_functions):
+        eps[..., ix] = e(wavelengths)
+    return eps
+
+
+def _pick_minima(kr, ki, k0, q, modenum, drop_edges):
+    """
+    Find the local minima of |q| separately for each entry along the leading
+    axis, and return the @modenum'th one as an effective index, or NaN if
+    there are not enough minima.
+    @drop_edges: whether to ignore minima on the left or bottom edge
+    """
+    nbatch = q.shape[0]
+    batch_ix, r_ix, i_ix = detect_local_minima(abs(q), ndim=2)
+    if drop_edges:
+        keep = (r_ix != 0) & (i_ix != 0)
+        batch_ix, r_ix, i_ix = batch_ix[keep], r_ix[keep], i_ix[keep]
+
+    # The minima are sorted along the batch axis, so the modenum'th minimum of
+    # each batch entry is an offset from the first minimum of that entry
+    pick = N.searchsorted(batch_ix, N.arange(nbatch)) + modenum
+    found = pick < batch_ix.size
+    found[found] = (batch_ix[pick[found]] == N.arange(nbatch)[found])
+
+    modes = N.empty(nbatch, dtype=complex)
+    modes.fill(N.nan)
+    rows = N.arange(nbatch)[found]
+    modes[found] = ((kr[rows, r_ix[pick[found]]]
+        + 1j * ki[rows, i_ix[pick[found]]]) / k0[found])
+    return modes
+
+
+def _zoom_minimum(k0, eps, d, mode, halfwidth, resolution, npoints=21):
+    """
+    Follow the local minimum of |M22| nearest to the effective index @mode
+    on a small grid of +/- @halfwidth, zooming in until the grid spacing is
+    below @resolution. Returns NaN if there is no minimum inside the window.
+    """
+    while True:
+        kr, ki, kSP = create_eigenvalue_grid(mode.real - halfwidth,
+            mode.real + halfwidth, mode.imag - halfwidth,
+            mode.imag + halfwidth, k0, npoints)
+        q = calc_eigenvalue_matrix(k0, eps, d, kSP)[..., 1, 1]
+        r_ix, i_ix = detect_local_minima(abs(q))
+        # A minimum on any edge means the mode is outside the window
+        interior = ((r_ix > 0) & (r_ix < npoints - 1)
+            & (i_ix > 0) & (i_ix < npoints - 2))
+        if not N.any(interior):
+            return N.nan + 0j
+        candidates = (kr[r_ix[interior]] + 1j * ki[i_ix[interior]]) / k0
+        mode = candidates[N.argmin(abs(candidates - mode))]
+
+        spacing = 2 * halfwidth / (npoints - 2)
+        if spacing <= resolution:
+            return mode
+        halfwidth = 2 * spacing
+
+
+def _track_dispersion(wavelengths, epsilons, thicknesses, modenum, bounds,
+    window, resolution, polish):
+    """
+    Follow one mode along the wavelength sweep, starting each wavelength
+    from a prediction extrapolated from the previous solutions.
+    """
+    xmin, xmax, ymin, ymax = bounds
+    if polish:
+        # Only locate the minimum on the first grid, and then polish it
+        resolution = N.inf
+    indices = N.empty(wavelengths.size, dtype=complex)
+    indices.fill(N.nan)
+
+    for ix, wl in enumerate(wavelengths.flat):
+        k0 = 2 * N.pi / wl
+        eps = epsilons[ix]
+
+        # Predict the mode from the previous one or two wavelengths
+        guess = None
+        if ix >= 1 and not N.isnan(indices[ix - 1]):
+            guess = indices[ix - 1]
+            halfwidth = window
+            if ix >= 2 and not N.isnan(indices[ix - 2]):
+                slope = ((indices[ix - 1] - indices[ix - 2])
+                    / (wavelengths.flat[ix - 1] - wavelengths.flat[ix - 2]))
+                guess = indices[ix - 1] + slope * (wl - wavelengths.flat[ix - 1])
+                # Widen the window when the mode is moving fast
+                halfwidth = max(window, 2 * abs(guess - indices[ix - 1]))
+            mode = _zoom_minimum(k0, eps, thicknesses, guess, halfwidth,
+                resolution)
+            if polish and not N.isnan(mode):
+                mode, converged = polish_mode(k0, eps, thicknesses, mode)
+                # Reject roots outside the window or the search region, which
+                # belong to another branch
+                if (not converged or abs(mode - guess) > halfwidth
+                    or not (xmin <= mode.real <= xmax
+                        and ymin <= mode.imag <= ymax)):
+                    mode = N.nan
+            if not N.isnan(mode):
+                indices[ix] = mode
+                continue
+
+        # No previous solution, or we lost the mode: search the whole grid
+        kr, ki, kSP = create_eigenvalue_grid(xmin, xmax, ymin, ymax, k0)
+        q = calc_eigenvalue_element(k0, eps, thicknesses, kSP)
+        r_ix, i_ix = detect_local_minima(abs(q))
+        # Remove minima that are on the left or bottom edge
+        keep = (r_ix != 0) & (i_ix != 0)
+        modes = (kr[r_ix[keep]] + 1j * ki[i_ix[keep]]) / k0
+        del kSP, q
+        if guess is not None and modes.size:
+            mode = modes[N.argmin(abs(modes - guess))]
+        elif modes.size > modenum:
+            mode = modes[modenum]
+        else:
+            warnings.warn('Mode {} not found at wavelength {}'.format(
+                modenum, wl))
+            continue
+        spacing = max((xmax - xmin) / (kr.size - 1), (ymax - ymin) / (ki.size - 1))
+        if polish:
+            mode, converged = polish_mode(k0, eps, thicknesses, mode)
+            if not converged:
+                warnings.warn('Mode {} did not converge at wavelength {}'
+                    .format(modenum, wl))
+                continue
+            if not (xmin <= mode.real <= xmax and ymin <= mode.imag <= ymax):
+                warnings.warn('Mode {} converged outside the bounds at '
+                    'wavelength {}'.format(modenum, wl))
+                continue
+            indices[ix] = mode
+        else:
+            indices[ix] = _zoom_minimum(k0, eps, thicknesses, mode,
+                2 * spacing, resolution)
+            if N.isnan(indices[ix]):
+                warnings.warn('Mode {} not found at wavelength {}'.format(
+                    modenum, wl))
+
+    return indices.reshape(wavelengths.shape)
+
+
 def dispersion_relation(wavelengths, epsilon_functions, thicknesses, modenum=0,
-    bounds=(1.0, 1.1, 0.0001, 0.1)):
+    bounds=(1.0, 1.1, 0.0001, 0.1), batch_size=1, track=False, window=1e-2,
+    resolution=1e-5, polish=False, contour=False):
+    """
+    Calculate the effective index of mode number @modenum at each of
+    @wavelengths, for a stack of layers with dielectric constants given by
+    @epsilon_functions and inner layer thicknesses @thicknesses.
+    @bounds: (min real, max real, min imag, max imag) of the effective index
+    region to search
+    @batch_size: number of wavelengths to solve in one vectorized pass. The
+    grid is evaluated in tiles to stay within default_memory, so large
+    batches only cost about 2 MB per wavelength for the grid and result.
+    @track: follow the mode from one wavelength to the next instead of
+    searching the whole @bounds region at every wavelength. Each wavelength is
+    searched only within +/- @window of a prediction extrapolated from the
+    previous two solutions, and refined down to @resolution; the full region
+    is only searched again if the mode is lost. This keeps the mode on the
+    same branch, so @modenum only selects the mode at the first wavelength.
+    @batch_size is ignored when tracking.
+    @polish: instead of refining the minimum on a finer grid, converge on the
+    zero of M22 with polish_mode(). This takes far fewer evaluations and gives
+    the index to machine precision rather than grid resolution.
+    @contour: find the modes at each wavelength with find_modes() instead of
+    the grid search. The modes are numbered in order of their real part, and
+    are always polished. @batch_size is ignored.
+    Wavelengths at which the mode could not be found are set to NaN.
+    """
+    wavelengths = N.asarray(wavelengths, dtype=float)
+    if track:
+        epsilons = layer_epsilons(wavelengths.ravel(), epsilon_functions)
+        return _track_dispersion(wavelengths, epsilons, thicknesses, modenum,
+            bounds, window, resolution, polish)
+
     indices = N.empty_like(wavelengths, dtype=complex)
     xmin, xmax, ymin, ymax = bounds
 
-    for ix, wl in enumerate(wavelengths):
-        epsilons = N.array([e(wl) for e in epsilon_functions])
+    if contour:
+        epsilons = layer_epsilons(wavelengths, epsilon_functions)
+        for ix, wl in enumerate(wavelengths.flat):
+            modes = find_modes(2 * N.pi / wl, epsilons.reshape(-1,
+                epsilons.shape[-1])[ix], thicknesses, bounds)
+            if modes.size > modenum:
+                indices.flat[ix] = modes[modenum]
+            else:
+                warnings.warn('Mode {} not found at wavelength {}'.format(
+                    modenum, wl))
+                indices.flat[ix] = N.nan
+        return indices
+
+    for start in range(0, wavelengths.size, batch_size):
+        wl = wavelengths.flat[start:start + batch_size]
+        epsilons = layer_epsilons(wl, epsilon_functions)
         k0 = 2 * N.pi / wl
 
         kr, ki, kSP = create_eigenvalue_grid(xmin, xmax, ymin, ymax, k0)
-        q = calc_eigenvalue_matrix(k0, epsilons, thicknesses, kSP)[..., 1, 1]
-        min_indices = detect_local_minima(abs(q))
+        q = calc_eigenvalue_element(k0, epsilons, thicknesses, kSP)
         # Remove minima that are on the left or bottom edge
-        min_indices = map(N.array,
-            zip(*[(x, y) for (x, y) in zip(*min_indices) if all((x, y))]))
-        modes = (kr[min_indices[0]] + 1j * ki[min_indices[1]]) / k0
-        mode = modes[modenum]
+        modes = _pick_minima(kr, ki, k0, q, modenum, drop_edges=True)
+        del kSP, q
 
-        # Recalculate, but with a finer grid
-        kr, ki, kSP = create_eigenvalue_grid(mode.real - 1e-3,
-            mode.real + 1e-3, mode.imag - 1e-3, mode.imag + 1e-3, k0)
-        q = calc_eigenvalue_matrix(k0, epsilons, thicknesses, kSP)[..., 1, 1]
-        min_indices = detect_local_minima(abs(q))
-        modes = (kr[min_indices[0]] + 1j * ki[min_indices[1]]) / k0
-        mode = modes[0]
+        found = ~N.isnan(modes)
+        if not N.all(found):
+            warnings.warn('Mode {} not found at wavelengths {}'.format(
+                modenum, wl[~found]))
+        if N.any(found) and polish:
+            modes[found], converged = polish_mode(k0[found], epsilons[found],
+                thicknesses, modes[found])
+            if not N.all(converged):
+                warnings.warn('Mode {} did not converge at wavelengths {}'
+                    .format(modenum, wl[found][~converged]))
+                modes[N.flatnonzero(found)[~converged]] = N.nan
+        elif N.any(found):
+            # Recalculate, but with a finer grid
+            mode, k0f = modes[found], k0[found]
+            kr, ki, kSP = create_eigenvalue_grid(mode.real - 1e-3,
+                mode.real + 1e-3, mode.imag - 1e-3, mode.imag + 1e-3, k0f)
+            q = calc_eigenvalue_element(k0f, epsilons[found], thicknesses,
+                kSP)
+            modes[found] = _pick_minima(kr, ki, k0f, q, 0, drop_edges=False)
+            del kSP, q
 
-        indices[ix] = mode
+        indices.flat[start:start + batch_size] = modes
 
     return indices
 
 
-def calc_eigenmode(k0, eps, d, mode, tail=1e-7, npoints=100):
+def calc_eigenmodes(k0, eps, d, modes, tail=1e-7, npoints=100):
     """
-    Calculate the complex magnetic field amplitude of the eigenmode.
+    Calculate the complex magnetic field amplitude of many eigenmodes at once,
+    for example along a dispersion curve.
+    @k0: free-space wave vector, scalar or array broadcastable with @modes
+    @eps: dielectric constants of the layers, shape (nlayers,) or
+    (..., nlayers) with leading dimensions broadcastable with @modes
+    @modes: effective indices, array of shape (...)
     @tail: Distance to show in the infinite border layers (nm)
+    Returns z, of shape (npoints,), and Hy, of shape (..., npoints).
     """
-    A = N.zeros((eps.shape[0], 2), dtype=complex)
-    A[0, 1] = 1.0
-    A[1, 1] = 1.0
-
-    kzmode = k0 * N.sqrt(eps - mode ** 2)
-    kzmode = N.where(kzmode.imag < 0, -kzmode, kzmode)
-    kzmode[0] *= -1
+    modes = N.asarray(modes)
+    eps = N.asarray(eps)
+    kz = N.asarray(k0)[..., N.newaxis] * N.sqrt(eps - modes[..., N.newaxis] ** 2)
+    kz = N.where(kz.imag < 0, -kz, kz)
+    kz[..., 0] *= -1
+    zeta = kz / eps
+    nlayers = kz.shape[-1]
 
-    for ix, (en, kzn, zn1) in \
-        enumerate(zip(eps[:-1], kzmode[:-1], kzmode[1:] / eps[1:])):
+    # Amplitudes of the forward and backward waves in each layer
+    A = N.zeros(kz.shape + (2,), dtype=complex)
+    A[..., 0, 1] = 1.0
+    A[..., 1, 1] = 1.0
 
+    for ix in range(nlayers - 1):
         if ix != 0:
-            M0 = N.zeros((2, 2), dtype=complex)
-            kd = 1j * kzn * d[ix - 1]
-            M0[0, 0] = N.exp(kd)[0]  # [0]: workaround for http://comments.gmane.org/gmane.comp.python.numeric.general/43850
-            M0[1, 1] = N.exp(-kd)[0]
+            kd = 1j * kz[..., ix] * d[ix - 1]
+            A[..., ix + 1, 0] = N.exp(kd) * A[..., ix, 0]
+            A[..., ix + 1, 1] = N.exp(-kd) * A[..., ix, 1]
             del kd
-            A[ix + 1, :] = N.dot(M0, A[ix, :])
-            del M0
 
-        M0 = N.ones((2, 2), dtype=complex)
-        zn = kzn / en
+        zn = zeta[..., ix]
+        zn1 = zeta[..., ix + 1]
         rn1n = (zn1 - zn) / (zn1 + zn)
         tn1n = 1 + rn1n
-        M0[1, 0] = rn1n[0]
-        M0[0, 1] = rn1n[0]
-        M0 /= tn1n
-        del zn, rn1n, tn1n
-        A[ix + 1, :] = N.dot(M0, A[ix + 1, :])
-        del M0
-
-    dn = d.sum()
-    z = N.linspace(-tail, tail + dn, npoints)
-    Hy = N.zeros_like(z, dtype=complex)
-
-    # Exponential tails in the outside layers
-    Hy[z < 0.0] = A[00, 1] * N.exp(1j * kzmode[00] * (z - 00))[z < 0.0]
-    Hy[z >= dn] = A[-1, 0] * N.exp(1j * kzmode[-1] * (z - dn))[z >= dn]
-
-    for ix, zn in enumerate(d.cumsum()):
-        z0 = zn - d[ix]
-        z_layer = z[(z >= z0) & (z < zn)] - z0
-        Hy[(z >= z0) & (z < zn)] = \
-            (A[ix + 1, 0] * N.exp(+1j * kzmode[ix + 1] * z_layer) +
-             A[ix + 1, 1] * N.exp(-1j * kzmode[ix + 1] * z_layer))
+        a0 = A[..., ix + 1, 0].copy()
+        a1 = A[..., ix + 1, 1].copy()
+        A[..., ix + 1, 0] = (a0 + rn1n * a1) / tn1n
+        A[..., ix + 1, 1] = (rn1n * a0 + a1) / tn1n
+        del zn, zn1, rn1n, tn1n, a0, a1
+
+    # In the outside layers there is only an exponential tail
+    A_plus = A[..., 0].copy()
+    A_minus = A[..., 1].copy()
+    A_plus[..., 0] = A[..., 0, 1]
+    A_minus[..., 0] = 0.0
+    A_minus[..., -1] = 0.0
+
+    boundaries = N.r_[0.0, N.cumsum(d)]
+    z = N.linspace(-tail, tail + boundaries[-1], npoints)
+    layer = N.searchsorted(boundaries, z, side='right')
+    z_layer = z - N.r_[0.0, boundaries][layer]
+
+    kz_z = kz[..., layer]
+    Hy = (A_plus[..., layer] * N.exp(+1j * kz_z * z_layer) +
+          A_minus[..., layer] * N.exp(-1j * kz_z * z_layer))
 
     return z, Hy
+
+
+def calc_eigenmode(k0, eps, d, mode, tail=1e-7, npoints=100):
+    """
+    Calculate the complex magnetic field amplitude of the eigenmode.
+    @tail: Distance to show in the infinite border layers (nm)
+    """
+    return calc_eigenmodes(k0, N.ravel(eps), d, N.squeeze(mode), tail, npoints)
+
+
+if __name__ == '__main__':
+    import timeit
+
+    # Check that the fused transfer matrix product agrees with einsum, both on
+    # a grid and on a column of trial modes as used by find_modes()
+    k0 = 2 * N.pi / 800e-9
+    _, _, kSP = create_eigenvalue_grid(1.0, 1.1, 0.0001, 0.1, k0)
+    eps = N.array([2.25, -29.3 + 2.1j, 1.0])
+    d = N.array([40e-9])
+    for trial in (kSP, kSP[:, :3].reshape(-1, 1, 1)):
+        assert N.allclose(calc_eigenvalue_matrix(k0, eps, d, trial),
+            calc_eigenvalue_matrix(k0, eps, d, trial, fused=False))
+    modes = find_modes(k0, eps, d)
+    assert N.allclose(eigenvalue_condition(k0, eps, d, modes), 0, atol=1e-8)
+    print('Modes of glass/Au/air: {0}'.format(modes))
+
+    # Benchmark the fused transfer matrix product against einsum, for a
+    # metal-insulator stack with an increasing number of layers
+    for nperiods in (1, 5, 15):
+        eps = N.array([1.0] + [-29.3 + 2.1j, 2.25] * nperiods + [1.0])
+        d = N.array([30e-9, 100e-9] * nperiods)
+        for fused in (False, True):
+            t = min(timeit.repeat(
+                lambda: calc_eigenvalue_matrix(k0, eps, d, kSP, fused=fused),
+                number=1, repeat=3))
+            print('{0} layers, {1}: {2:.3f} s'.format(eps.size,
+                'fused' if fused else 'einsum', t))
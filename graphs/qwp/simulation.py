@@ -10,7 +10,7 @@ class SlitSystem:
     def __init__(self, slit_widths, wavelength, metal_epsilon, metal_thickness,
         incidence_index, slit_index, outcoupling_index, collection_index,
         numerical_aperture, angle_of_incidence,
-        C1=1.0, C2=1.0, C3=1.0, caching=True):
+        C1=1.0, C2=1.0, C3=1.0, caching=True, mode_indices=None):
         """
         Do the calculations for the subwavelength slit system.
 
@@ -29,8 +29,10 @@ class SlitSystem:
         @angle_of_incidence: Angle under which the plane wave is incident on the
         slit.
         @C1, @C2, @C3: fitting parameter.
-        @caching: whether to try to read the waveguide calculation from a file,
-        and write it out if it is not there.
+        @caching: whether to try to read the waveguide calculation from the
+        shared cache of waveguide.py, and store it there if it is not there.
+        @mode_indices: a waveguide.ModeIndexTable for the metal and slit index,
+        from which to interpolate the waveguide calculation instead.
         """
         # Shorthand for parameters
         b = slit_widths
@@ -62,14 +64,15 @@ class SlitSystem:
         # Snyder & Love, pp. 240-244.
 
         # Propagation constants of fundamental slit waveguide mode
-        if caching:
-            cache_filename = 'waveguide_eff_indices_{0}_{1}.txt'.format(int(wl * 1e9), b.size)
-            try:
-                beta_TE, beta_TM = N.loadtxt(cache_filename, unpack=True).view(complex)
-            except IOError:
-                from waveguide import effective_mode_indices
-                beta_TE, beta_TM = effective_mode_indices(b, eps, n2, wl,
-                    filename=cache_filename)
+        if mode_indices is not None:
+            if (mode_indices.n2 != n2
+                    or not N.allclose(mode_indices.epsilon_function(wl), eps)):
+                warnings.warn('Mode index table was computed for a different '
+                    + 'metal or slit index.')
+            beta_TE, beta_TM = mode_indices(b, wl)
+        elif caching:
+            from waveguide import cached_effective_mode_indices
+            beta_TE, beta_TM = cached_effective_mode_indices(b, eps, n2, wl)
         else:
             from waveguide import effective_mode_indices
             beta_TE, beta_TM = effective_mode_indices(b, eps, n2, wl, filename=None)
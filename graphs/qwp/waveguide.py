@@ -1,3 +1,6 @@
+import glob
+import hashlib
+import os
 import numpy as N
 from scipy.optimize import fsolve
 
@@ -35,6 +38,30 @@ def ev_TM(beta_packed, epsilon, n2, b, wl):
     return pack_into_real(n22 * W1 / (epsilon * U1) - N.tan(0.5 * b * U1))
 
 
+def ev_pole_free(beta, epsilon, n2, b, wl, TM=False):
+    """
+    Eigenvalue equation ev_TE (or ev_TM if @TM is True) for complex @beta,
+    multiplied by U1 cos(b U1 / 2) to remove the poles of the tangent, which
+    keeps Newton's method from overshooting. Returns the function and its
+    analytic derivative with respect to beta.
+    """
+    k02 = (2 * N.pi / wl) ** 2
+    n22 = n2 ** 2
+    W1 = N.sqrt(beta ** 2 - k02 * epsilon)
+    U1 = N.sqrt(k02 * n22 - beta ** 2)
+    sine, cosine = N.sin(0.5 * b * U1), N.cos(0.5 * b * U1)
+    if TM:
+        p, q = n22, epsilon
+    else:
+        p, q = 1.0, 1.0
+    dW1 = beta / W1
+    dU1 = -beta / U1
+    f = p * W1 * cosine - q * U1 * sine
+    df = (p * (dW1 * cosine - 0.5 * b * dU1 * W1 * sine)
+        - q * dU1 * (sine + 0.5 * b * U1 * cosine))
+    return f, df
+
+
 # Initial guesses for solver
 def TE_guess(b, wl):
     """Initial TE guess"""
@@ -49,49 +76,265 @@ def TM_guess(b):
     return ny_TM_guess
 
 
-def _solve_beta(b, epsilon, n2, wl, beta_TE_guess, beta_TM_guess, verbose=False):
-    """Solve the eigenvalue equations numerically"""
+def _newton_beta(b, epsilon, n2, wl, beta_guess, TM=False, tol=1e-12,
+    maxiter=50, max_step=0.2):
+    """
+    Solve the TE (or TM) eigenvalue equation for all widths @b at once, with a
+    complex Newton step on ev_pole_free. Steps are limited to @max_step times
+    |beta|, so that the solution stays on the branch of the guess. Each width
+    stops when its step is smaller than @tol relative to beta. Returns beta,
+    with the sign that makes the mode decay along the slit, an array of
+    booleans telling which widths converged, and the number of iterations
+    for each width.
+    """
+    beta = N.array(beta_guess, dtype=complex)
+    converged = N.zeros(beta.shape, dtype=bool)
+    iterations = N.zeros(beta.shape, dtype=int)
+    with N.errstate(invalid='ignore', over='ignore', divide='ignore'):
+        for _ in range(maxiter):
+            active = N.nonzero(~converged)[0]
+            if active.size == 0:
+                break
+            iterations[active] += 1
+            f, df = ev_pole_free(beta[active], epsilon, n2, b[active], wl, TM)
+            step = f / df
+            limit = max_step * N.abs(beta[active])
+            too_large = N.abs(step) > limit
+            step[too_large] *= limit[too_large] / N.abs(step[too_large])
+            beta[active] -= step
+            converged[active] = N.abs(step) <= tol * N.abs(beta[active])
+    # beta and -beta are both solutions
+    beta[beta.imag < 0] *= -1
+    return beta, converged, iterations
+
+
+def _continue_beta(b, epsilon, n2, wl, beta_guess, TM=False, tol=1e-12,
+    maxiter=10, max_jump=0.1, max_halvings=8):
+    """
+    Solve the TE (or TM) eigenvalue equation by continuation along the slit
+    width. Starting at the narrowest width for which @beta_guess converges,
+    the widths are solved in order, towards wider and then towards narrower
+    slits, each with Newton's method starting from a secant prediction
+    through the two previous solutions. Where Newton does not converge within
+    @maxiter iterations, or ends up further than @max_jump times |beta| from
+    the prediction, the width step is halved, up to @max_halvings times, to
+    follow the branch through the difficult region.
+    Returns, in the order of @b: beta (NaN where the branch was lost), the
+    number of Newton iterations for each width, and an array of booleans
+    telling whether the branch is a guided mode (Re beta > Im beta) or below
+    cutoff at that width.
+    """
+    order = N.argsort(b)
+    widths = b[order]
+    beta = N.zeros(b.shape, dtype=complex) + N.nan
+    iterations = N.zeros(b.shape, dtype=int)
+
+    start_beta, converged, start_iterations = _newton_beta(widths, epsilon, n2,
+        wl, N.asarray(beta_guess)[order], TM)
+    if not N.any(converged):
+        return beta, iterations, N.zeros(b.shape, dtype=bool)
+    start = N.argmax(converged)
+    beta[start] = start_beta[start]
+    iterations[start] = start_iterations[start]
+
+    for indices in (range(start + 1, widths.size), range(start - 1, -1, -1)):
+        # Last two solutions on the branch, as (width, beta)
+        points = [(widths[start], beta[start])]
+        for ix in indices:
+            target = widths[ix]
+            step = target - points[-1][0]
+            halvings = 0
+            while True:
+                width, current = points[-1]
+                if abs(step) >= abs(target - width):
+                    trial = target
+                else:
+                    trial = width + step
+                if len(points) > 1:
+                    previous_width, previous = points[-2]
+                    predicted = current + ((current - previous)
+                        * (trial - width) / (width - previous_width))
+                else:
+                    predicted = current
+                solution, ok, its = _newton_beta(N.array([trial]), epsilon, n2,
+                    wl, N.array([predicted]), TM, tol, maxiter)
+                iterations[ix] += its[0]
+                if ok[0] and (abs(solution[0] - predicted)
+                        <= max_jump * abs(current)):
+                    points = [points[-1], (trial, solution[0])]
+                    if trial == target:
+                        beta[ix] = solution[0]
+                        break
+                    # Try the rest of the way in one step again
+                    step = target - trial
+                    continue
+                halvings += 1
+                if halvings > max_halvings:
+                    break
+                step *= 0.5
+
+    retval = N.empty_like(beta)
+    retval[order] = beta
+    retiterations = N.empty_like(iterations)
+    retiterations[order] = iterations
+    return retval, retiterations, retval.real > retval.imag
+
+
+def _print_branch(label, b, beta, guided):
+    """Print where the mode found by continuation changes branch or fails"""
+    order = N.argsort(b)
+    for ix in N.nonzero(N.diff(guided[order]))[0]:
+        print "{0} mode is {1} from a width of {2} nm".format(label,
+            'guided' if guided[order][ix + 1] else 'cut off',
+            b[order][ix + 1] * 1e9)
+    for width in b[N.isnan(beta)]:
+        print "For width={0} nm, no {1} solution found by continuation".format(width * 1e9, label)
+
+
+def _fsolve_beta(ev, width, epsilon, n2, wl, beta_guess, label, failures=None):
+    """
+    Solve one eigenvalue equation with fsolve, or return NaN and print why,
+    or append (width, label, message) to @failures if given
+    """
+    beta_packed, _, ier, mesg = fsolve(ev,
+        pack_into_real(beta_guess),
+        args=(epsilon, n2, width, wl),
+        full_output=True)
+    if ier != 1:
+        if failures is None:
+            print "For width={0} nm, no {1} solution found: {2}".format(width * 1e9, label, mesg)
+        else:
+            failures.append((width, label, mesg))
+        return N.nan
+    return unpack_into_complex(beta_packed)[0]
+
 
-    # Output arrays
-    beta_TE = N.zeros(b.shape, dtype=complex)
-    beta_TM = N.zeros_like(beta_TE)
+def _solve_beta(b, epsilon, n2, wl, beta_TE_guess, beta_TM_guess, verbose=False,
+    failures=None):
+    """
+    Solve the eigenvalue equations numerically: Newton's method for all widths
+    at once, then fsolve for the widths where that did not converge
+    """
+    beta_TE, TE_converged, _ = _newton_beta(b, epsilon, n2, wl, beta_TE_guess)
+    beta_TM, TM_converged, _ = _newton_beta(b, epsilon, n2, wl, beta_TM_guess,
+        TM=True)
 
-    for ix, width in enumerate(b):
+    for ix in N.nonzero(~(TE_converged & TM_converged))[0]:
         if verbose:
             print ix,
-            if ix % 10 == 9:
-                print ' '
-
-        # first TE
-        beta_packed, _, ier, mesg = fsolve(ev_TE,
-            pack_into_real(beta_TE_guess[ix]),
-            args=(epsilon, n2, width, wl),
-            full_output=True)
-        if ier != 1:
-            print "For width={0} nm, no TE solution found: {1}".format(width * 1e9, mesg)
-            beta_TE[ix] = N.nan
-        else:
-            beta_TE[ix] = unpack_into_complex(beta_packed)[0]
-
-        # then TM
-        beta_packed, _, ier, mesg = fsolve(ev_TM,
-            pack_into_real(beta_TM_guess[ix]),
-            args=(epsilon, n2, width, wl),
-            full_output=True)
-        if ier != 1:
-            print "For width={0} nm, no TM solution found: {1}".format(width * 1e9, mesg)
-            beta_TM[ix] = N.nan
-        else:
-            beta_TM[ix] = unpack_into_complex(beta_packed)[0]
+        if not TE_converged[ix]:
+            beta_TE[ix] = _fsolve_beta(ev_TE, b[ix], epsilon, n2, wl,
+                beta_TE_guess[ix], 'TE', failures)
+        if not TM_converged[ix]:
+            beta_TM[ix] = _fsolve_beta(ev_TM, b[ix], epsilon, n2, wl,
+                beta_TM_guess[ix], 'TM', failures)
 
     return beta_TE, beta_TM
 
 
-def effective_mode_indices(b, epsilon, n2, wl, filename='waveguide_eff_indices.txt', verbose=True):
+def _solve_shard(args):
+    """Solve the modes for one shard of widths in a worker process"""
+    b, epsilon, n2, wl = args
+    failures = []
+    beta_TE, beta_TM = _solve_beta(b, epsilon, n2, wl, TE_guess(b, wl),
+        TM_guess(b), failures=failures)
+    return beta_TE, beta_TM, failures
+
+
+def _continue_mode(args):
+    """Continue one mode over all the widths in a worker process"""
+    b, epsilon, n2, wl, TM = args
+    guess = TM_guess(b) if TM else TE_guess(b, wl)
+    beta, _, _ = _continue_beta(b, epsilon, n2, wl, guess, TM=TM)
+    label = 'TM' if TM else 'TE'
+    failures = [(width, label, 'no solution found by continuation')
+        for width in b[N.isnan(beta)]]
+    return beta, failures
+
+
+def parallel_effective_mode_indices(b, epsilon, n2, wl, continuation=False,
+    processes=None, shards=None, progress=None):
+    """
+    Propagation constants of the fundamental TE and TM modes of slits with
+    widths @b, like effective_mode_indices(), but with the widths split into
+    @shards contiguous shards (by default four per process) that are solved
+    in a pool of @processes worker processes (by default one per CPU). With
+    @continuation, the widths are not split, since separately continued
+    shards could end up on different branches at their boundaries; instead
+    the TE and TM modes are each continued over all widths in their own
+    process.
+
+    Nothing is printed; instead @progress(done, total) is called, if given,
+    each time a shard or mode is finished. Returns beta_TE, beta_TM in the order of
+    @b regardless of which worker finished first, and a list of
+    (width, mode, message) tuples, sorted by width, for the widths where no
+    solution was found.
+    """
+    import multiprocessing
+
+    b = N.asarray(b, dtype=float)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if shards is None:
+        shards = 4 * processes
+    shards = max(1, min(shards, b.size))
+    if continuation:
+        worker = _continue_mode
+        tasks = [(b, epsilon, n2, wl, TM) for TM in (False, True)]
+    else:
+        worker = _solve_shard
+        tasks = [(shard, epsilon, n2, wl) for shard in N.array_split(b, shards)]
+
+    results = []
+    pool = multiprocessing.Pool(min(processes, len(tasks)))
+    try:
+        # imap() returns the results in the order of the tasks
+        for result in pool.imap(worker, tasks):
+            results.append(result)
+            if progress is not None:
+                progress(len(results), len(tasks))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if continuation:
+        (beta_TE, TE_failures), (beta_TM, TM_failures) = results
+        failures = TE_failures + TM_failures
+    else:
+        beta_TE = N.concatenate([result[0] for result in results])
+        beta_TM = N.concatenate([result[1] for result in results])
+        failures = sum([result[2] for result in results], [])
+    failures.sort(key=lambda failure: failure[0])
+    return beta_TE, beta_TM, failures
+
+
+def effective_mode_indices(b, epsilon, n2, wl, filename='waveguide_eff_indices.txt', verbose=True, continuation=False, processes=1):
+    """
+    Propagation constants of the fundamental TE and TM modes of slits with
+    widths @b. With @continuation, each mode is followed along the width
+    starting from one converged width, instead of solving each width from its
+    own initial guess; this is more robust where the guesses are poor. With
+    @processes other than 1, the widths are solved in parallel by
+    parallel_effective_mode_indices() (None means one process per CPU.)
+    """
     beta_TE_guess = TE_guess(b, wl)
     beta_TM_guess = TM_guess(b)
 
-    beta_TE, beta_TM = _solve_beta(b, epsilon, n2, wl, beta_TE_guess, beta_TM_guess, verbose)
+    if processes != 1:
+        beta_TE, beta_TM, failures = parallel_effective_mode_indices(b,
+            epsilon, n2, wl, continuation, processes)
+        if verbose:
+            for width, label, message in failures:
+                print "For width={0} nm, no {1} solution found: {2}".format(width * 1e9, label, message)
+    elif continuation:
+        beta_TE, _, TE_guided = _continue_beta(b, epsilon, n2, wl, beta_TE_guess)
+        beta_TM, _, TM_guided = _continue_beta(b, epsilon, n2, wl, beta_TM_guess, TM=True)
+        if verbose:
+            _print_branch('TE', b, beta_TE, TE_guided)
+            _print_branch('TM', b, beta_TM, TM_guided)
+    else:
+        beta_TE, beta_TM = _solve_beta(b, epsilon, n2, wl, beta_TE_guess, beta_TM_guess, verbose)
 
     if verbose:
         print ' '
@@ -103,6 +346,182 @@ def effective_mode_indices(b, epsilon, n2, wl, filename='waveguide_eff_indices.t
 
     return beta_TE, beta_TM
 
+
+# Shared cache of effective_mode_indices() results for all scripts, and the
+# size up to which it may grow before the least recently used are deleted
+default_cache_dir = os.environ.get('WAVEGUIDE_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'waveguide_cache'))
+default_cache_size = 256 * 2 ** 20
+
+# Change this when the solver changes its results, to invalidate the cache
+_cache_version = 1
+
+
+def _cache_key(*inputs):
+    """SHA-1 hash of the solver inputs, which are numbers or arrays"""
+    key = hashlib.sha1()
+    for value in inputs + (_cache_version,):
+        value = N.ascontiguousarray(value)
+        key.update(repr((value.dtype.str, value.shape)).encode('ascii'))
+        key.update(value.tobytes())
+    return key.hexdigest()
+
+
+def _evict_least_recently_used(cache_dir, max_bytes):
+    """Delete the least recently used cache files until @max_bytes are left"""
+    entries = []
+    for path in glob.glob(os.path.join(cache_dir, '*.npy')):
+        try:
+            entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+        except OSError:
+            pass  # deleted by another process in the meantime
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def _load_cached(filename):
+    """
+    Memory-map a cached array copy-on-write, so that changing it does not
+    change the cache, and mark it as used; or return None
+    """
+    try:
+        retval = N.load(filename, mmap_mode='c')
+        os.utime(filename, None)
+        return retval
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _store_cached(filename, array, cache_dir, max_bytes):
+    """
+    Store an array in the cache, if possible, and return it memory-mapped
+    from there like _load_cached(), or else the array itself
+    """
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Write under a temporary name, so that other processes never read a
+        # partially written file
+        temp_filename = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(temp_filename, 'wb') as temp_file:
+            N.save(temp_file, array)
+        os.rename(temp_filename, filename)
+        _evict_least_recently_used(cache_dir, max_bytes)
+    except (IOError, OSError):
+        return array
+    stored = _load_cached(filename)
+    return array if stored is None else stored
+
+
+def cached_effective_mode_indices(b, epsilon, n2, wl, continuation=False,
+    cache_dir=None, max_bytes=default_cache_size, verbose=True):
+    """
+    effective_mode_indices(), with the results stored in @cache_dir (by
+    default default_cache_dir, which can be set with the environment variable
+    WAVEGUIDE_CACHE_DIR) as .npy files named after a hash of all the inputs,
+    so that a result is only ever reused for exactly the same widths, metal
+    epsilon, slit index and wavelength. Files are touched when they are
+    used, and the least recently used ones are deleted when the cache grows
+    beyond @max_bytes. The results are returned as copy-on-write memory maps
+    of the cache file, whether or not they were computed in this call, so
+    they can be changed in place without changing the cache; only if the
+    cache cannot be written are they ordinary arrays.
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir
+    filename = os.path.join(cache_dir, _cache_key(N.asarray(b, dtype=float),
+        complex(epsilon), complex(n2), float(wl), continuation) + '.npy')
+    betas = _load_cached(filename)
+    if betas is not None:
+        return betas[0], betas[1]
+
+    beta_TE, beta_TM = effective_mode_indices(b, epsilon, n2, wl,
+        filename=None, verbose=verbose, continuation=continuation)
+    betas = _store_cached(filename, N.array([beta_TE, beta_TM]), cache_dir,
+        max_bytes)
+    return betas[0], betas[1]
+
+
+class ModeIndexTable:
+    """
+    Propagation constants of the fundamental TE and TM modes, tabulated over
+    slit width and wavelength for one metal, so that they can be looked up by
+    interpolation instead of solving the eigenvalue equations each time.
+    """
+    def __init__(self, epsilon_function, b, wl, n2=1.0, cache_dir=None,
+        max_bytes=default_cache_size, verbose=False):
+        """
+        Compute the table, or memory-map it from the cache of
+        cached_effective_mode_indices() if it was computed before. The
+        beta_TE and beta_TM attributes are copy-on-write memory maps of the
+        cache file in both cases, as in cached_effective_mode_indices().
+
+        @epsilon_function: dielectric constant of the metal as a function of
+        wavelength in meters, e.g. epsilons.epsilon_Au.
+        @b: increasing array of slit widths, in meters.
+        @wl: increasing array of wavelengths, in meters.
+        @n2: index of refraction of the medium inside the slit.
+        """
+        self.epsilon_function = epsilon_function
+        self.b = N.asarray(b, dtype=float)
+        self.wl = N.asarray(wl, dtype=float)
+        self.n2 = n2
+        if N.any(N.diff(self.b) <= 0) or N.any(N.diff(self.wl) <= 0):
+            raise ValueError('Widths and wavelengths must be increasing')
+        self.epsilon = N.asarray(epsilon_function(self.wl), dtype=complex)
+
+        if cache_dir is None:
+            cache_dir = default_cache_dir
+        filename = os.path.join(cache_dir, _cache_key(self.b, self.wl,
+            self.epsilon, complex(n2), 'table') + '.npy')
+        betas = _load_cached(filename)
+        if betas is None:
+            betas = N.empty((2, self.wl.size, self.b.size), dtype=complex)
+            for ix, (epsilon, wavelength) in enumerate(zip(self.epsilon, self.wl)):
+                betas[:, ix] = effective_mode_indices(self.b, epsilon, n2,
+                    wavelength, filename=None, verbose=verbose,
+                    continuation=True)
+            betas = _store_cached(filename, betas, cache_dir, max_bytes)
+        self.beta_TE, self.beta_TM = betas
+
+        # Interpolate the effective indices, which depend on the wavelength
+        # much more smoothly than the propagation constants themselves
+        k0 = 2 * N.pi / self.wl[:, N.newaxis]
+        self._neff_TE = self.beta_TE / k0
+        self._neff_TM = self.beta_TM / k0
+
+    def __call__(self, b, wl):
+        """
+        Bilinearly interpolated propagation constants (beta_TE, beta_TM) at
+        slit widths @b and wavelengths @wl, which are broadcast against each
+        other. Points next to where the solver found no solution are NaN.
+        """
+        b, wl = N.broadcast_arrays(N.asarray(b, dtype=float),
+            N.asarray(wl, dtype=float))
+        if (N.any(b < self.b[0]) or N.any(b > self.b[-1])
+                or N.any(wl < self.wl[0]) or N.any(wl > self.wl[-1])):
+            raise ValueError('Slit width or wavelength outside of the table')
+
+        ib = N.clip(N.searchsorted(self.b, b, side='right') - 1, 0, self.b.size - 2)
+        iwl = N.clip(N.searchsorted(self.wl, wl, side='right') - 1, 0, self.wl.size - 2)
+        tb = (b - self.b[ib]) / (self.b[ib + 1] - self.b[ib])
+        twl = (wl - self.wl[iwl]) / (self.wl[iwl + 1] - self.wl[iwl])
+
+        k0 = 2 * N.pi / wl
+        retval = []
+        for neff in self._neff_TE, self._neff_TM:
+            interpolated = ((1 - twl) * ((1 - tb) * neff[iwl, ib] + tb * neff[iwl, ib + 1])
+                + twl * ((1 - tb) * neff[iwl + 1, ib] + tb * neff[iwl + 1, ib + 1]))
+            retval.append(interpolated * k0)
+        return tuple(retval)
+
 if __name__ == '__main__':
     import matplotlib.pyplot as P
 